@@ -1,20 +1,29 @@
 import importlib
+import os
 import pkgutil
 import sys
+from datetime import datetime, timedelta
 from typing import List
 
+from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from tqdm import tqdm
 
 import job_search.sites
-from job_search.model import PageCount, Listing, SearchQuery, Location, JobStatus, Status
-from job_search.utilities.job_util import pass_blacklist
+from job_search.model import PageCount, SearchQuery, Location, User
+from job_search.utilities.driver_util import get_page_soup
+from job_search.utilities.job_util import ListingRecord, save_listings
 from job_search.utilities.logger import progress_bars, logger
 
 HTML_PARSER = "html.parser"
 
 load_dotenv()
 
+# How often a query is crawled to the last page to catch up on listings missed by incremental crawls
+FULL_CRAWL_INTERVAL_DAYS = int(os.getenv("FULL_CRAWL_INTERVAL_DAYS", 7))
+# Number of consecutive pages without new listings after which an incremental crawl stops
+INCREMENTAL_STOP_PAGES = int(os.getenv("INCREMENTAL_STOP_PAGES", 2))
+
 
 class NotSupportedError(Exception):
     pass
@@ -29,6 +38,13 @@ class BaseSite:
     LISTING_URL: str
     SITE_STRING: str
 
+    # Whether search/listing pages are static HTML that can be fetched without a browser. The browser is still used as a
+    # fallback when the plain response fails or looks like a block page.
+    PLAIN_HTTP_SEARCH: bool = False
+    PLAIN_HTTP_LISTING: bool = False
+    # Site specific text which indicates a plain HTTP response is a block or login page
+    BLOCK_PAGE_MARKERS: List[str] = []
+
     def __init__(self, query_url: str, listing_url: str, site_string: str) -> None:
         """
         Constructor.
@@ -41,17 +57,34 @@ class BaseSite:
         self.LISTING_URL = listing_url
         self.SITE_STRING = site_string.lower()
 
-    def download_new_listings(self, query: SearchQuery) -> None:
+    def download_new_listings(self, query: SearchQuery, users: List[User] | None = None) -> None:
         """
         Download new listings by iterating through pages using the QUERY_URL, incrementing the page.
+        Results are sorted newest first, so incremental crawls stop once INCREMENTAL_STOP_PAGES consecutive pages contain
+        no new listings. A full crawl to the last page is done every FULL_CRAWL_INTERVAL_DAYS.
 
         query -- The Query object containing information about the current search.
-        """
-        friendly_query = f"{query.term}, {query.location.name}" + (", Remote" if query.remote else "")
+        users -- The users subscribed to the search, defaults to the owner of the query. Each user gets a status for every
+        listing found, with their own blacklist applied.
+        """
+        if users is None:
+            users = [query.user]
+
+        # Queries differing in any filter are crawled separately, so each needs its own page counts
+        friendly_query = (
+            f"{query.term}, {query.location.name}"
+            + (", Remote" if query.remote else "")
+            + (f", Last {query.days_since_post} days" if query.days_since_post != 0 else "")
+        )
         page_count: PageCount = PageCount.get_or_create(site=self.SITE_STRING, query=friendly_query)[0]
-        expected_pages = page_count.pages
+        crawl_started = datetime.now()
+        full_crawl = page_count.last_full_crawl is None or (
+            crawl_started - page_count.last_full_crawl > timedelta(days=FULL_CRAWL_INTERVAL_DAYS)
+        )
+        expected_pages = page_count.pages if full_crawl else (page_count.incremental_pages or page_count.pages)
 
         page_num = 0
+        known_pages = 0
         with tqdm(
             total=expected_pages,
             desc=f"{self.SITE_STRING} - {friendly_query}",
@@ -60,29 +93,34 @@ class BaseSite:
             disable=not progress_bars,
         ) as pbar:
             while True:
-                listings = self.get_listings_from_page(query, page_num)
-                if len(listings) == 0:
+                records = self.get_listings_from_page(query, page_num)
+                if len(records) == 0:
                     break
 
-                for listing in listings:
-                    # Create a status for the job if it doesn't already exist
-                    JobStatus.get_or_create(
-                        user=query.user,
-                        job=listing.job,
-                        defaults={
-                            "status": Status.NEW if pass_blacklist(listing.job, query.user) else Status.BLACKLIST
-                        },
-                    )
+                # Saves the page and creates a status for each user if they don't already have one
+                listings = save_listings(records, users)
 
                 page_num += 1
                 if page_num > expected_pages:
                     pbar.total += 1
                 pbar.update()
 
-        page_count.pages = page_num
+                # Listings created during this crawl are timestamped after it started
+                if any(listing.timestamp >= crawl_started for listing in listings):
+                    known_pages = 0
+                else:
+                    known_pages += 1
+                if not full_crawl and known_pages >= INCREMENTAL_STOP_PAGES:
+                    break
+
+        if full_crawl:
+            page_count.pages = page_num
+            page_count.last_full_crawl = crawl_started
+        else:
+            page_count.incremental_pages = page_num
         page_count.save()
 
-        logger.info(f"Completed query {friendly_query}")
+        logger.info(f"Completed {"full" if full_crawl else "incremental"} query {friendly_query}")
 
     def build_page_link(self, query: SearchQuery, page_number: int):
         """
@@ -121,18 +159,18 @@ class BaseSite:
         """
         raise NotImplementedError
 
-    def get_listings_from_page(self, query: SearchQuery, page_number) -> List[Listing]:
+    def get_listings_from_page(self, query: SearchQuery, page_number) -> List[ListingRecord]:
         """
-        Retrieves Listings from a given page number.
+        Retrieves parsed listings from a given page number. The listings are not saved, see job_util.save_listings.
 
         page_number -- The page number of the search. For sites which require increments larger than +1 are handled inside this function.
         query -- The search query.
         """
         raise NotImplementedError
 
-    def extract_info(self, listing) -> Listing:
+    def extract_info(self, listing) -> ListingRecord:
         """
-        Extracts information from BeautifulSoup page element into a Listing.
+        Extracts information from BeautifulSoup page element into a ListingRecord.
 
         listing -- Element to extract information from.
         """
@@ -152,6 +190,22 @@ class BaseSite:
         """
         raise NotImplementedError
 
+    def get_search_soup(self, link: str) -> BeautifulSoup:
+        """
+        Retrieves a search page, using plain HTTP if the site supports it.
+
+        link -- The URL of the search page.
+        """
+        return get_page_soup(link, plain_http=self.PLAIN_HTTP_SEARCH, block_markers=self.BLOCK_PAGE_MARKERS)
+
+    def get_listing_soup(self, link: str) -> BeautifulSoup:
+        """
+        Retrieves an individual listing page, using plain HTTP if the site supports it.
+
+        link -- The URL of the listing page.
+        """
+        return get_page_soup(link, plain_http=self.PLAIN_HTTP_LISTING, block_markers=self.BLOCK_PAGE_MARKERS)
+
     def add_remote_filter(self, query_string: str) -> str:
         """
         Adds a remote work filter to the query string.
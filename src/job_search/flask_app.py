@@ -25,10 +25,11 @@ from job_search.model import (
     Status,
     JobTimestamp,
 )
+from job_search.migrations import migrate
 from job_search.search import search
 from job_search.utilities.auto_apply import run_applier, notify_user
 from job_search.utilities.clean import clean
-from job_search.utilities.job_util import pass_blacklist
+from job_search.utilities.job_util import apply_blacklist, invalidate_blacklist
 from job_search.utilities.logger import logger, configure_logging
 
 INVALID_REQUEST = "Invalid request"
@@ -105,14 +106,17 @@ def triage(job_id=None):
     """Triage page for new jobs"""
 
     if job_id is None:
-        jobs = list(
+        # Jobs are triaged in id order, which clean relies on to prepare the next jobs first
+        job = (
             Job.select()
             .join(JobStatus)
             .where((JobStatus.status == Status.NEW) & (JobStatus.user == session["user_id"]))
+            .order_by(Job.id)
+            .first()
         )
-        if len(jobs) == 0:
+        if job is None:
             return redirect(url_for("index"))
-        return redirect(url_for("triage", job_id=jobs[0].id))
+        return redirect(url_for("triage", job_id=job.id))
 
     # Get the next job to triage
     job = Job.get(Job.id == job_id)
@@ -324,6 +328,7 @@ def add_blacklist_term():
     try:
         term_type = request.args.get("type")
         BlacklistTerm.create(term=term, type=term_type, user=session["user_id"])
+        invalidate_blacklist(session["user_id"])
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 400
@@ -339,6 +344,7 @@ def delete_blacklist_term(term):
         & (BlacklistTerm.type == requested_type)
     )
     deleted = q.execute()
+    invalidate_blacklist(session["user_id"])
     return jsonify({"deleted": deleted})
 
 
@@ -351,17 +357,9 @@ def manage_blacklist_terms():
 @app.route("/run_blacklist", methods=["POST"])
 @require_user
 def run_blacklist():
-    user_id = session["user_id"]
+    blacklisted, restored = apply_blacklist(session["user_id"])
 
-    new_statuses = JobStatus.select().where((JobStatus.user == user_id) & (JobStatus.status == Status.NEW))
-    filtered_count = 0
-    for status in new_statuses:
-        if not pass_blacklist(status.job, user_id):
-            status.status = Status.BLACKLIST
-            status.save()
-            filtered_count += 1
-
-    return jsonify({"message": f"Blacklist run. {filtered_count} jobs filtered."})
+    return jsonify({"message": f"Blacklist run. {blacklisted} jobs filtered, {restored} jobs restored."})
 
 
 @app.route("/applied", methods=["GET", "POST"])
@@ -500,22 +498,20 @@ def _db_close(_):
 
 
 def run_tasks():
-    with db:
-        # Run search twice since often we get different ones on a second run
-        search()
+    with db.connection_context():
         search()
         clean()
 
 
 def run_apply():
-    with db:
+    with db.connection_context():
         users = User.select().where(User.email.is_null(False))
         for user in users:
             run_applier(user)
 
 
 def run_apply_notify():
-    with db:
+    with db.connection_context():
         users = User.select().where(User.webhook_url.is_null(False))
         for user in users:
             notify_user(user, datetime.datetime.now() - datetime.timedelta(hours=24))
@@ -523,6 +519,7 @@ def run_apply_notify():
 
 def start():
     configure_logging()
+    migrate()
     logger.info("Scheduling tasks")
     # TODO Make this configurable through .env or web gui
     scheduler.add_job(run_tasks, "cron", hour=1, minute=0)
@@ -0,0 +1,125 @@
+"""
+Versioned schema migrations for changes that peewee's create_tables doesn't make to existing databases, such as new
+columns, secondary indexes and views.
+
+Migrations are applied in order and each one is recorded in the "schemaversion" table, so every migration runs once per
+database. New migrations must be appended to the end of MIGRATIONS and never reordered. They should be idempotent (e.g.
+IF NOT EXISTS) since fresh databases already have the current tables from init_db.
+"""
+
+from typing import Callable, List
+
+from job_search.model import Job, SchemaVersion, db, init_db
+from job_search.utilities.logger import configure_logging, logger
+
+
+def _create_jobtimestamp_view():
+    db.execute_sql("""
+        CREATE OR REPLACE VIEW jobtimestamp(job_id, timestamp) AS
+        SELECT j.id, MAX(l.timestamp)
+        FROM job j
+                 JOIN listing l ON j.id = l.job_id
+        GROUP BY j.id
+        """)
+
+
+def _add_page_count_depths():
+    db.execute_sql("""
+        ALTER TABLE pagecount
+            ADD COLUMN IF NOT EXISTS incremental_pages INTEGER NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS last_full_crawl TIMESTAMP NULL
+        """)
+
+
+def _add_job_fuzzy_key():
+    db.execute_sql("ALTER TABLE job ADD COLUMN IF NOT EXISTS fuzzy_key TEXT NULL")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS job_fuzzy_key ON job (fuzzy_key)")
+
+    # The key is computed in Python so it matches Job.make_fuzzy_key exactly
+    batch_size = 1000
+    while len(jobs := list(Job.select().where(Job.fuzzy_key.is_null()).limit(batch_size))) > 0:
+        for job in jobs:
+            job.fuzzy_key = Job.make_fuzzy_key(job.title, job.company)
+        Job.bulk_update(jobs, fields=[Job.fuzzy_key])
+        logger.info(f"Backfilled fuzzy keys for {len(jobs)} jobs")
+
+
+def _add_hot_query_indexes():
+    db.execute_sql("CREATE INDEX IF NOT EXISTS jobstatus_user_id_status ON jobstatus (user_id, status)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS listing_job_id ON listing (job_id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS listing_timestamp ON listing (timestamp)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS blacklistterm_user_id_type ON blacklistterm (user_id, type)")
+
+
+def _add_listing_summary_ref():
+    # The summary table itself is created by init_db
+    db.execute_sql("ALTER TABLE listing ADD COLUMN IF NOT EXISTS summary_ref_id INTEGER NULL REFERENCES summary (id)")
+    db.execute_sql("CREATE INDEX IF NOT EXISTS listing_summary_ref_id ON listing (summary_ref_id)")
+
+
+def _add_listing_summary_changed():
+    # Existing listings all start out changed so the first run checks each of them once
+    db.execute_sql("ALTER TABLE listing ADD COLUMN IF NOT EXISTS summary_changed TIMESTAMP NULL DEFAULT NOW()")
+    db.execute_sql("ALTER TABLE listing ALTER COLUMN summary_changed DROP DEFAULT")
+    db.execute_sql("""
+        CREATE INDEX IF NOT EXISTS listing_summary_changed ON listing (summary_changed)
+            WHERE summary_changed IS NOT NULL
+        """)
+    db.execute_sql("CREATE INDEX IF NOT EXISTS summary_model_prompt_hash ON summary (model, prompt_hash)")
+
+    # Status changes can change whether a listing needs a summary, so mark the job's listings as changed
+    db.execute_sql("""
+        CREATE OR REPLACE FUNCTION mark_listing_summary_changed() RETURNS TRIGGER AS
+        $$
+        BEGIN
+            IF TG_OP = 'INSERT' OR OLD.status IS DISTINCT FROM NEW.status THEN
+                UPDATE listing SET summary_changed = NOW() WHERE job_id = NEW.job_id;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """)
+    db.execute_sql("DROP TRIGGER IF EXISTS jobstatus_summary_changed ON jobstatus")
+    db.execute_sql("""
+        CREATE TRIGGER jobstatus_summary_changed
+            AFTER INSERT OR UPDATE OF status
+            ON jobstatus
+            FOR EACH ROW
+        EXECUTE FUNCTION mark_listing_summary_changed()
+        """)
+
+
+# Version n is MIGRATIONS[n - 1]
+MIGRATIONS: List[Callable[[], None]] = [
+    _create_jobtimestamp_view,
+    _add_page_count_depths,
+    _add_job_fuzzy_key,
+    _add_hot_query_indexes,
+    _add_listing_summary_ref,
+    _add_listing_summary_changed,
+]
+
+
+def migrate():
+    """
+    Creates any missing tables and applies any migrations which haven't been applied yet. Run on deployment before the
+    app, search or clean are started.
+    """
+    configure_logging()
+    init_db()
+
+    with db.connection_context():
+        applied = {v.version for v in SchemaVersion.select()}
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version in applied:
+                continue
+            logger.info(f"Applying migration {version}: {migration.__name__.strip('_')}")
+            with db.atomic():
+                migration()
+                SchemaVersion.create(version=version)
+
+    logger.info(f"Database is at version {len(MIGRATIONS)}")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -1,5 +1,6 @@
 import datetime
 import os
+import re
 from enum import Enum
 
 from dotenv import load_dotenv
@@ -9,23 +10,31 @@ from peewee import (
     CharField,
     ForeignKeyField,
     IntegerField,
+    BigIntegerField,
+    BlobField,
     CompositeKey,
     TextField,
-    PostgresqlDatabase,
     BooleanField,
     DateTimeField,
 )
 from peewee_enum_field import EnumField
+from playhouse.pool import PooledPostgresqlDatabase
 
 load_dotenv()
 
-db = PostgresqlDatabase(
+# Connections are pooled and shared between the web server and scheduler threads. Each thread must release its
+# connection with db.close() (or use a connection context) to return it to the pool.
+db = PooledPostgresqlDatabase(
     os.getenv("DATABASE_NAME", "job_search"),
     user=os.getenv("DATABASE_USER"),
     password=os.getenv("DATABASE_PASSWORD"),
     host=os.getenv("DATABASE_HOST"),
+    max_connections=int(os.getenv("DATABASE_MAX_CONNECTIONS", 20)),
+    # Idle connections older than this are discarded instead of reused
+    stale_timeout=int(os.getenv("DATABASE_STALE_TIMEOUT", 300)),
+    # Time to wait for a free connection when the pool is exhausted
+    timeout=30,
 )
-db.connect()
 
 
 class BaseModel(Model):
@@ -46,6 +55,19 @@ class Job(BaseModel):
     id = AutoField(primary_key=True)
     title = TextField()
     company = TextField()
+    # Normalised title and company used to match listings of the same job, see make_fuzzy_key
+    fuzzy_key = TextField(null=True, index=True)
+
+    @staticmethod
+    def make_fuzzy_key(title: str, company: str) -> str:
+        """
+        Turns the title and company into a fuzzy string by removing any non-word characters and the "ptyltd" suffix
+        """
+        return re.sub(r"\W", "", title.lower()) + "-" + re.sub(r"\W", "", company.lower()).removesuffix("ptyltd")
+
+    def save(self, *args, **kwargs):
+        self.fuzzy_key = Job.make_fuzzy_key(self.title, self.company)
+        return super().save(*args, **kwargs)
 
 
 class Status(Enum):
@@ -68,6 +90,7 @@ class JobStatus(BaseModel):
 
     class Meta:
         primary_key = CompositeKey("user", "job")
+        indexes = ((("user", "status"), False),)
 
 
 class JobTimestamp(BaseModel):
@@ -84,18 +107,70 @@ class Site(BaseModel):
     name = TextField()
 
 
+class Summary(BaseModel):
+    """
+    A summary of a description, shared by every listing with an identical description. Summaries are only reused for
+    the model and prompt which created them.
+    """
+
+    id = AutoField(primary_key=True)
+    description_hash = TextField()
+    model = TextField()
+    prompt_hash = TextField()
+    text = TextField()
+    created = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (("description_hash", "model", "prompt_hash"), True),
+            (("model", "prompt_hash"), False),
+        )
+
+
 class Listing(BaseModel):
     id = TextField(primary_key=True)
     job = ForeignKeyField(Job)
     site = ForeignKeyField(Site)
+    # Copy of the summary's text (or "blacklist"/"N/A") for display
     summary = TextField(null=True)
-    timestamp = DateTimeField(default=datetime.datetime.now)
+    summary_ref = ForeignKeyField(Summary, null=True, index=True)
+    # When the listing's statuses or description last changed, or None once create_summary has caught up with it
+    summary_changed = DateTimeField(null=True, default=datetime.datetime.now)
+    timestamp = DateTimeField(default=datetime.datetime.now, index=True)
+
+
+class DescriptionSignature(BaseModel):
+    """
+    MinHash signature of a listing's description, see utilities/minhash.py. Empty if the listing has no description.
+    """
+
+    listing = ForeignKeyField(Listing, primary_key=True)
+    signature = BlobField()
+
+
+class DescriptionBand(BaseModel):
+    """
+    LSH bucket of one band of a listing's description signature. Listings sharing a bucket in any band are candidate
+    near-duplicates.
+    """
+
+    listing = ForeignKeyField(Listing, index=True)
+    band = IntegerField()
+    bucket = BigIntegerField()
+
+    class Meta:
+        primary_key = CompositeKey("listing", "band")
+        indexes = ((("band", "bucket"), False),)
 
 
 class PageCount(BaseModel):
     site = CharField()
     query = CharField()
+    # Depth of the last full crawl
     pages = IntegerField(default=1)
+    # Depth of the last incremental crawl
+    incremental_pages = IntegerField(default=0)
+    last_full_crawl = DateTimeField(null=True)
 
     class Meta:
         primary_key = CompositeKey("site", "query")
@@ -141,5 +216,38 @@ class BlacklistTerm(BaseModel):
     user = ForeignKeyField(User)
     auto_applier = BooleanField(default=True)
 
+    class Meta:
+        indexes = ((("user", "type"), False),)
+
 
-db.create_tables([Job, JobStatus, Listing, PageCount, SearchQuery, Site, SiteQuery, BlacklistTerm, User], safe=True)
+class SchemaVersion(BaseModel):
+    """
+    Records which migrations (see migrations.py) have been applied.
+    """
+
+    version = IntegerField(primary_key=True)
+    applied = DateTimeField(default=datetime.datetime.now)
+
+
+def init_db():
+    """
+    Creates any missing tables. Changes to existing tables are made by migrations.migrate, which calls this first.
+    """
+    with db.connection_context():
+        models = [
+            Job,
+            JobStatus,
+            Listing,
+            PageCount,
+            SearchQuery,
+            Site,
+            SiteQuery,
+            BlacklistTerm,
+            User,
+            Summary,
+            DescriptionSignature,
+            DescriptionBand,
+            SchemaVersion,
+        ]
+        # Existing tables are left alone, as create_tables would also create indexes on columns added by migrations
+        db.create_tables([model for model in models if not model.table_exists()], safe=True)
@@ -1,22 +1,110 @@
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue, Empty
+from typing import List, NamedTuple
+
 from tqdm import tqdm
 
 from job_search.utilities.logger import progress_bars, configure_logging, logger
-from job_search.model import SearchQuery, SiteQuery
+from job_search.model import SearchQuery, SiteQuery, Site, User, db
 from job_search.base_site import BaseSite, NotSupportedError
+from job_search.utilities.job_embeddings import job_index
+
+# Number of queries run at the same time against a single site
+SEARCH_SITE_CONCURRENCY = int(os.getenv("SEARCH_SITE_CONCURRENCY", 1))
+
+
+class CrawlQuery(NamedTuple):
+    """
+    A unique search to crawl once, along with every user subscribed to it.
+    """
+
+    site_name: str
+    query: SearchQuery
+    users: List[User]
 
 
 def search():
     configure_logging()
     logger.info("Starting search")
-    queries = list(SiteQuery.select().join(SearchQuery).where(SearchQuery.auto_apply == False))
-    for query in tqdm(queries, desc="Queries", unit="query", leave=False, disable=not progress_bars):
-        try:
-            site = BaseSite.get_site_instance(query.site.name)
-            site.download_new_listings(query.query)
-        except NotSupportedError:
-            # Some sites do not support certain filters; skip these
-            # TODO Disable the ability to enable these sites when the filters are enabled
-            pass
+    site_queries = list(
+        SiteQuery.select(SiteQuery, SearchQuery, Site, User)
+        .join(SearchQuery)
+        .join(User)
+        .switch(SiteQuery)
+        .join(Site)
+        .where(SearchQuery.auto_apply == False)
+    )
+    queries = collapse_queries(site_queries)
+    logger.info(f"Crawling {len(queries)} unique queries for {len(site_queries)} site queries")
+
+    # Group the work per site so each site is only hit by a limited number of workers at a time
+    site_queues: dict[str, Queue[CrawlQuery]] = defaultdict(Queue)
+    for query in queries:
+        site_queues[query.site_name].put(query)
+
+    lanes = [
+        (BaseSite.get_site_instance(site_name), site_queue)
+        for site_name, site_queue in site_queues.items()
+        for _ in range(SEARCH_SITE_CONCURRENCY)
+    ]
+    if len(lanes) == 0:
+        return
+
+    with (
+        tqdm(total=len(queries), desc="Queries", unit="query", leave=False, disable=not progress_bars) as pbar,
+        ThreadPoolExecutor(max_workers=len(lanes)) as executor,
+    ):
+        futures = [executor.submit(run_site_queries, site, site_queue, pbar) for site, site_queue in lanes]
+        for future in as_completed(futures):
+            future.result()
+
+    if job_index is not None:
+        job_index.save()
+
+
+def collapse_queries(site_queries: List[SiteQuery]) -> List[CrawlQuery]:
+    """
+    Collapses site queries which would produce identical crawls into a single query with all of their users.
+
+    site_queries -- The site queries to collapse.
+    """
+    crawls: dict[tuple, CrawlQuery] = {}
+    for site_query in site_queries:
+        query: SearchQuery = site_query.query
+        key = (site_query.site.id, query.term.strip().lower(), query.location, query.remote, query.days_since_post)
+        if key not in crawls:
+            crawls[key] = CrawlQuery(site_query.site.name, query, [])
+        if query.user.id not in [u.id for u in crawls[key].users]:
+            crawls[key].users.append(query.user)
+    return list(crawls.values())
+
+
+def run_site_queries(site: BaseSite, site_queue: Queue[CrawlQuery], pbar: tqdm):
+    """
+    Worker which runs queries for a single site until there are none left.
+
+    site -- The site the queries are for.
+    site_queue -- The queue of remaining queries for the site, shared between workers of the same site.
+    pbar -- The overall progress bar.
+    """
+    with db.connection_context():
+        while True:
+            try:
+                query = site_queue.get_nowait()
+            except Empty:
+                return
+
+            try:
+                site.download_new_listings(query.query, query.users)
+            except NotSupportedError:
+                # Some sites do not support certain filters; skip these
+                # TODO Disable the ability to enable these sites when the filters are enabled
+                pass
+            except Exception as e:
+                logger.warn(f"Error in query {query.query.term} for {site.SITE_STRING}: {type(e).__name__} - {e}")
+            pbar.update()
 
 
 if __name__ == "__main__":
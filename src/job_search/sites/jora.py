@@ -2,9 +2,8 @@ import re
 from typing import List
 
 from job_search.base_site import BaseSite, NotSupportedError
-from job_search.model import Listing, SearchQuery, Location
-from job_search.utilities.driver_util import get_page_soup
-from job_search.utilities.job_util import get_or_create_listing
+from job_search.model import SearchQuery, Location
+from job_search.utilities.job_util import ListingRecord
 
 
 class Jora(BaseSite):
@@ -17,15 +16,15 @@ class Jora(BaseSite):
 
     def get_listing_description(self, listing_id) -> str | None:
         link = self.build_listing_link(listing_id)
-        soup = get_page_soup(link)
+        soup = self.get_listing_soup(link)
         body = soup.find("div", attrs={"id": "job-description-container"})
         if body is not None:
             body = body.text
         return body
 
-    def get_listings_from_page(self, query: SearchQuery, page_number: int) -> List[Listing]:
+    def get_listings_from_page(self, query: SearchQuery, page_number: int) -> List[ListingRecord]:
         link = self.build_page_link(query, page_number)
-        soup = get_page_soup(link)
+        soup = self.get_search_soup(link)
         if soup.text.find("We have looked through all the results for you") != -1:
             return []
         last_page_number_div = soup.find_all("div", attrs={"class": "search-results-page-number"})
@@ -55,12 +54,12 @@ class Jora(BaseSite):
         }
         return query_string + "&l=" + location_map[location]
 
-    def extract_info(self, listing) -> Listing:
+    def extract_info(self, listing) -> ListingRecord:
         link = listing["href"]
         listing_id = link[link.rindex("/") + 1 : link.index("?")]
         title = listing.text
         company = listing.parent.parent.parent.parent.find("span", attrs={"class", "job-company"}).text
-        return get_or_create_listing(listing_id, self.SITE_STRING, title, company)
+        return ListingRecord(listing_id, self.SITE_STRING, title, company)
 
     def add_remote_filter(self, query_string: str) -> str:
         raise NotSupportedError
@@ -2,12 +2,16 @@ from time import sleep
 from typing import List
 
 from job_search.base_site import BaseSite
-from job_search.model import Listing, SearchQuery, Location
-from job_search.utilities.driver_util import get_page_soup
-from job_search.utilities.job_util import get_or_create_listing
+from job_search.model import SearchQuery, Location
+from job_search.utilities.job_util import ListingRecord
 
 
 class LinkedIn(BaseSite):
+    # The guest search API and public job pages are static HTML
+    PLAIN_HTTP_SEARCH = True
+    PLAIN_HTTP_LISTING = True
+    BLOCK_PAGE_MARKERS = ["Join LinkedIn", "authwall"]
+
     def __init__(self):
         super().__init__(
             "https://www.linkedin.com/jobs-guest/jobs/api/seeMoreJobPostings/search?keywords=%%QUERY%%&start=%%PAGE%%&geoId=101452733",
@@ -16,19 +20,16 @@ class LinkedIn(BaseSite):
         )
 
     def get_listing_description(self, listing_id) -> str | None:
+        # LinkedIn often serves a page without the description, the description fetcher retries these with backoff
         link = self.build_listing_link(listing_id)
-        body = None
-        error_count = 0
-        while body is None and error_count < 5:
-            soup = get_page_soup(link)
-            body = soup.find("div", attrs={"class": "show-more-less-html__markup"})
-            error_count += 1
+        soup = self.get_listing_soup(link)
+        body = soup.find("div", attrs={"class": "show-more-less-html__markup"})
         # noinspection PyUnresolvedReferences
         return None if body is None else body.text
 
-    def get_listings_from_page(self, query: SearchQuery, page_number: int) -> List[Listing]:
+    def get_listings_from_page(self, query: SearchQuery, page_number: int) -> List[ListingRecord]:
         link = self.build_page_link(query, page_number * 10)
-        while "Join LinkedIn" in (soup := get_page_soup(link)).text:
+        while "Join LinkedIn" in (soup := self.get_search_soup(link)).text:
             sleep(1)
         cards = soup.find_all("li")
         if len(cards) == 0:
@@ -56,7 +57,7 @@ class LinkedIn(BaseSite):
         }
         return query_string + "&geoId=" + location_map[location]
 
-    def extract_info(self, listing) -> Listing | None:
+    def extract_info(self, listing) -> ListingRecord | None:
         links = listing.find_all("a")
         if len(links) == 0:
             return None
@@ -71,7 +72,7 @@ class LinkedIn(BaseSite):
             company = "None"
         else:
             company = links[1].text.strip()
-        return get_or_create_listing(listing_id, self.SITE_STRING, title, company)
+        return ListingRecord(listing_id, self.SITE_STRING, title, company)
 
     def add_remote_filter(self, query_string: str) -> str:
         return query_string + "&f_WT=2"
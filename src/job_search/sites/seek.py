@@ -1,12 +1,15 @@
 from typing import List
 
 from job_search.base_site import BaseSite
-from job_search.model import Listing, SearchQuery, Location
-from job_search.utilities.driver_util import get_page_soup
-from job_search.utilities.job_util import get_or_create_listing
+from job_search.model import SearchQuery, Location
+from job_search.utilities.job_util import ListingRecord
 
 
 class Seek(BaseSite):
+    # Search results and job details are server-side rendered
+    PLAIN_HTTP_SEARCH = True
+    PLAIN_HTTP_LISTING = True
+
     def __init__(self):
         super().__init__(
             "https://au.seek.com/%%QUERY%%-jobs?page=%%PAGE%%",
@@ -16,15 +19,15 @@ class Seek(BaseSite):
 
     def get_listing_description(self, listing_id) -> str | None:
         link = self.build_listing_link(listing_id)
-        soup = get_page_soup(link)
+        soup = self.get_listing_soup(link)
         body = soup.find("div", attrs={"data-automation": "jobAdDetails"})
         if body is None:
             return None
         return body.contents[0].text
 
-    def get_listings_from_page(self, query: SearchQuery, page_number: int) -> List[Listing]:
+    def get_listings_from_page(self, query: SearchQuery, page_number: int) -> List[ListingRecord]:
         link = self.build_page_link(query, page_number)
-        soup = get_page_soup(link)
+        soup = self.get_search_soup(link)
         matches = soup.find_all("a", attrs={"data-automation": "jobTitle"})
         matches = [self.extract_info(x) for x in matches]
 
@@ -44,7 +47,7 @@ class Seek(BaseSite):
         index = query_string.index("?")
         return query_string[:index] + "/" + location_map[location] + query_string[index:]
 
-    def extract_info(self, listing) -> Listing:
+    def extract_info(self, listing) -> ListingRecord:
         link = listing["href"]
         listing_id = link[link.rindex("/") + 1 : link.index("?")]
         title = listing.string
@@ -53,7 +56,7 @@ class Seek(BaseSite):
             company = company_field.string
         else:
             company = "None"
-        return get_or_create_listing(listing_id, self.SITE_STRING, title, company)
+        return ListingRecord(listing_id, self.SITE_STRING, title, company)
 
     def add_remote_filter(self, query_string: str) -> str:
         index = query_string.index("?")
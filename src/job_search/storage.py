@@ -1,6 +1,20 @@
+import atexit
+import gzip
+import hashlib
+import json
 import os
+import re
+import sqlite3
 import tarfile
+import time
+import uuid
+import zipfile
+import zlib
 from abc import ABC, abstractmethod
+from collections import defaultdict, OrderedDict
+from queue import Queue, Empty
+from threading import RLock, Lock, Thread, local
+from typing import Iterable, Set, Dict, Tuple, List, NamedTuple
 
 import boto3
 
@@ -9,9 +23,17 @@ import botocore
 
 from job_search.utilities.logger import logger
 
+try:
+    # Only available from Python 3.14
+    from compression import zstd
+except ImportError:
+    zstd = None
+
 
 class Storage(ABC):
     archived_names = set()
+    # Whether description_hash is answered without reading the description, otherwise hash what's read instead
+    hashes_without_reading = False
 
     @abstractmethod
     def __init__(self):
@@ -29,6 +51,101 @@ class Storage(ABC):
     def description_downloaded(self, listing_id: str) -> bool:
         pass
 
+    def descriptions_downloaded(self, listing_ids: Iterable[str]) -> Set[str]:
+        """
+        Returns which of the given listings have had their description downloaded.
+        By default, checks each listing individually.
+        """
+        return {listing_id for listing_id in listing_ids if self.description_downloaded(listing_id)}
+
+    def write_descriptions(self, descriptions: Dict[str, str]) -> None:
+        """
+        Writes a batch of descriptions keyed by listing id. By default, writes each description individually.
+        """
+        for listing_id, description in descriptions.items():
+            self.write_description(description, listing_id)
+
+    def read_descriptions(self, listing_ids: Iterable[str]) -> Dict[str, str]:
+        """
+        Reads a batch of descriptions, returning those which exist keyed by listing id.
+        By default, reads each description individually.
+        """
+        descriptions = {}
+        for listing_id in self.descriptions_downloaded(listing_ids):
+            if (description := self.read_description(listing_id)) is not None:
+                descriptions[listing_id] = description
+        return descriptions
+
+    def archive_descriptions(self, listing_ids: Iterable[str]) -> int:
+        """
+        Moves the descriptions of the given listings into long term storage, returning how many were moved.
+        Does nothing by default, for storage which doesn't distinguish between recent and archived descriptions.
+        """
+        return 0
+
+    def flush(self) -> None:
+        """
+        Blocks until all written descriptions are durably stored. Does nothing by default, for storage which writes
+        synchronously.
+        """
+        pass
+
+    def description_hash(self, listing_id: str) -> str | None:
+        """
+        Returns the content hash of the listing's description, or None if it hasn't been downloaded. Listings with the
+        same hash have identical descriptions, so work derived from the description only needs doing once.
+        """
+        description = self.read_description(listing_id) if self.description_downloaded(listing_id) else None
+        return None if description is None else hash_description(description)
+
+    def write_object(self, key: str, data: bytes) -> None:
+        """
+        Writes raw bytes under the given key, for storage layers built on top of this one.
+        """
+        raise NotImplementedError
+
+    def write_objects(self, objects: Dict[str, bytes], if_missing: Iterable[str] = ()) -> None:
+        """
+        Writes several objects in order, stopping at the first which fails. By default, writes each object individually.
+
+        objects -- The data to write keyed by object key, in the order to write it.
+        if_missing -- Keys which are only written if they haven't been already, e.g. content addressed data.
+        """
+        existing = self.objects_exist(if_missing)
+        for key, data in objects.items():
+            if key not in existing:
+                self.write_object(key, data)
+
+    def read_object(self, key: str) -> bytes | None:
+        """
+        Reads the raw bytes written under the given key, or None if there are none.
+        """
+        raise NotImplementedError
+
+    def objects_exist(self, keys: Iterable[str]) -> Set[str]:
+        """
+        Returns which of the given keys have been written.
+        """
+        raise NotImplementedError
+
+
+def hash_description(description: str) -> str:
+    """
+    Returns the content hash of a description.
+    """
+    return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+
+# Marks that the listing directory uses the sharded layout
+SHARDED_MARKER = ".sharded"
+
+
+def _shard(listing_id: str) -> str:
+    """
+    Returns the subdirectory a listing's description is stored in.
+    """
+    return hashlib.md5(listing_id.encode("utf-8")).hexdigest()[:2]
+
 
 class FileStorage(Storage):
     def __init__(self):
@@ -36,15 +153,38 @@ class FileStorage(Storage):
             logger.warn("DATA_DIRECTORY not set, defaulting to ./data")
             data_dir = "./data"
         self.listing_directory = data_dir + "/listings"
-        self.data_archive = data_dir + "/data-archive.tar.gz"
+        self.object_directory = data_dir + "/objects"
+        self.data_directory = data_dir
+        # The first archive, later batches are written to numbered segments alongside it (see archive_descriptions)
+        self.data_archive = data_dir + "/data-archive.zip"
+        legacy_archive = data_dir + "/data-archive.tar.gz"
+
+        os.makedirs(self.listing_directory, exist_ok=True)
+        if not os.path.exists(self.listing_directory + "/" + SHARDED_MARKER):
+            self._shard_listing_directory()
 
+        if not os.path.exists(self.data_archive) and os.path.exists(legacy_archive):
+            convert_tar_archive(legacy_archive, self.data_archive)
+
+        # Opening a zip only reads its central directory, which holds the offset of every independently compressed
+        # member, so each archived read is a single seek
+        self.archive_lock = RLock()
+        self.archives: Dict[str, zipfile.ZipFile] = {}
+        self.archived_names = set()
+        self.next_segment = 1
+        segments = []
+        for entry in os.scandir(data_dir):
+            if (match := re.fullmatch(r"data-archive-(\d+)\.zip", entry.name)) is not None:
+                segments.append((int(match.group(1)), entry.path))
+                self.next_segment = max(self.next_segment, int(match.group(1)) + 1)
         if os.path.exists(self.data_archive):
-            with tarfile.open(self.data_archive, "r") as tar:
-                self.archived_names = set(tar.getnames())
+            segments.append((0, self.data_archive))
+        for _, path in sorted(segments):
+            self._open_archive(path)
 
     def write_description(self, description: str, listing_id: str) -> None:
         """
-        Writes the description of the listing to the file "{LISTING_DIRECTORY}/{listing_id}.txt"
+        Writes the description of the listing to the file "{LISTING_DIRECTORY}/{shard}/{listing_id}.txt"
 
         description -- The description to write
         listing_id -- The id of the listing
@@ -53,40 +193,196 @@ class FileStorage(Storage):
             logger.debug(f"Description for {listing_id} was empty")
             return
         try:
-            with open(self._description_path(listing_id), "w+") as f:
+            path = self._description_path(listing_id)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w+") as f:
                 f.write(description)
         except OSError as e:
             logger.warn(f"Error writing file for listing {listing_id}: {type(e).__name__} - {e}")
 
     def read_description(self, listing_id: str) -> str | None:
         """
-        Read the description of the file from "{LISTING_DIRECTORY}/{listing_id}.txt" or the archive.
+        Read the description of the file from "{LISTING_DIRECTORY}/{shard}/{listing_id}.txt" or the archive.
         """
         path = self._description_path(listing_id)
         if os.path.exists(path):
             with open(path, "r") as f:
                 return f.read()
-        elif listing_id in self.archived_names:
-            with tarfile.open(self.data_archive, "r") as tar:
-                file = tar.extractfile(listing_id)
-                return None if file is None else file.read().decode("utf-8")
-        else:
-            return None
+        with self.archive_lock:
+            if listing_id in self.archived_names:
+                return self.archives[listing_id].read(listing_id).decode("utf-8")
+        return None
 
     def description_downloaded(self, listing_id: str) -> bool:
         """
         Checks if the description of the listing has been downloaded.
         """
-        return os.path.exists(self._description_path(listing_id)) or listing_id in self.archived_names
+        return listing_id in self.archived_names or os.path.exists(self._description_path(listing_id))
+
+    def descriptions_downloaded(self, listing_ids: Iterable[str]) -> Set[str]:
+        """
+        Checks the archive index, then lists each shard directory containing any of the remaining listings once.
+        """
+        remaining = set(listing_ids)
+        downloaded = remaining & self.archived_names
+        remaining -= downloaded
+
+        by_shard = defaultdict(set)
+        for listing_id in remaining:
+            by_shard[_shard(listing_id)].add(listing_id)
+        for shard, shard_ids in by_shard.items():
+            try:
+                with os.scandir(f"{self.listing_directory}/{shard}") as entries:
+                    downloaded |= shard_ids & {entry.name.removesuffix(".txt") for entry in entries}
+            except FileNotFoundError:
+                continue
+        return downloaded
+
+    def archive_descriptions(self, listing_ids: Iterable[str]) -> int:
+        """
+        Moves the loose description files of the given listings into a new archive segment and removes the files.
+        Existing segments are never modified, and the new one is written to a temporary file first, so an interrupted
+        run can't corrupt archived descriptions.
+        """
+        with self.archive_lock:
+            # Each shard is listed once rather than checking every listing, as most old listings are already archived
+            # or never had a description
+            to_archive = sorted(self.descriptions_downloaded(set(listing_ids) - self.archived_names))
+            if len(to_archive) == 0:
+                return 0
+
+            path = f"{self.data_directory}/data-archive-{self.next_segment}.zip"
+            try:
+                with zipfile.ZipFile(path + ".tmp", "w", zipfile.ZIP_DEFLATED) as archive:
+                    for listing_id in to_archive:
+                        archive.write(self._description_path(listing_id), listing_id)
+                os.replace(path + ".tmp", path)
+            finally:
+                if os.path.exists(path + ".tmp"):
+                    os.remove(path + ".tmp")
+            self.next_segment += 1
+            self._open_archive(path)
+
+        # Only remove the loose files once the archive has been written, so descriptions are always readable
+        for listing_id in to_archive:
+            os.remove(self._description_path(listing_id))
+        return len(to_archive)
+
+    def write_object(self, key: str, data: bytes) -> None:
+        path = f"{self.object_directory}/{key}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first so a partially written object is never read
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def read_object(self, key: str) -> bytes | None:
+        try:
+            with open(f"{self.object_directory}/{key}", "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def objects_exist(self, keys: Iterable[str]) -> Set[str]:
+        by_directory = defaultdict(set)
+        for key in keys:
+            directory, _, name = f"{self.object_directory}/{key}".rpartition("/")
+            by_directory[directory].add(name)
+
+        existing = set()
+        for directory, names in by_directory.items():
+            try:
+                with os.scandir(directory) as entries:
+                    found = names & {entry.name for entry in entries}
+            except FileNotFoundError:
+                continue
+            existing |= {f"{directory}/{name}".removeprefix(self.object_directory + "/") for name in found}
+        return existing
+
+    def _open_archive(self, path: str) -> None:
+        """
+        Opens an archive segment and indexes its members, later segments take precedence.
+        """
+        archive = zipfile.ZipFile(path, "r")
+        for name in archive.namelist():
+            self.archives[name] = archive
+        self.archived_names.update(archive.namelist())
 
     def _description_path(self, listing_id: str) -> str:
         """
-        Returns the path to the description file for the given listing
+        Returns the path to the description file for the given listing. Files are spread over subdirectories by a
+        prefix of the hash of the listing id to keep directories small.
+        """
+        return f"{self.listing_directory}/{_shard(listing_id)}/{listing_id}.txt"
+
+    def _shard_listing_directory(self) -> None:
+        """
+        Moves description files from the old flat layout into their shard subdirectories.
         """
-        return f"{self.listing_directory}/{listing_id}.txt"
+        moved = 0
+        with os.scandir(self.listing_directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".txt"):
+                    path = self._description_path(entry.name.removesuffix(".txt"))
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    os.replace(entry.path, path)
+                    moved += 1
+        open(self.listing_directory + "/" + SHARDED_MARKER, "w").close()
+        if moved > 0:
+            logger.info(f"Moved {moved} descriptions into sharded directories")
+
+
+def convert_tar_archive(tar_path: str, zip_path: str) -> None:
+    """
+    Converts a gzipped tar archive of descriptions into a zip archive, streaming through the tar in a single pass.
+    The zip is written to a temporary file first so an interrupted conversion is retried on the next start.
+
+    tar_path -- The path of the existing tar archive
+    zip_path -- The path to write the zip archive to
+    """
+    logger.info(f"Converting {tar_path} to {zip_path}")
+    temp_path = zip_path + ".tmp"
+    count = 0
+    with tarfile.open(tar_path, "r|gz") as tar, zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for member in tar:
+            if not member.isfile():
+                continue
+            file = tar.extractfile(member)
+            if file is not None:
+                archive.writestr(member.name, file.read())
+                count += 1
+    os.replace(temp_path, zip_path)
+    logger.info(f"Converted {count} archived descriptions")
+
+
+# Bulk existence checks for fewer listings than this use individual HEAD requests instead of listing the bucket
+S3_HEAD_LIMIT = 50
+# Time an upload worker waits for more descriptions to fill a pack
+S3_PACK_WAIT = 1.0
+S3_PACK_PREFIX = "packs/"
+S3_OBJECT_PREFIX = "objects/"
+
+
+class ObjectUpload(NamedTuple):
+    """
+    Objects queued to be uploaded together, see Storage.write_objects.
+    """
+
+    objects: Dict[str, bytes]
+    if_missing: Set[str]
 
 
 class S3Storage(Storage):
+    """
+    Stores each description as "{listing_id}.txt" in the "job-search" bucket.
+
+    Writes are uploaded in the background by S3_UPLOAD_WORKERS workers from a queue of at most S3_UPLOAD_QUEUE_SIZE
+    descriptions, and are readable from memory until they are uploaded. If S3_PACK_SIZE is more than 1, queued
+    descriptions are uploaded together in pack objects "packs/{id}.pack" of individually gzipped descriptions, along
+    with an index "packs/{id}.json" of the offset and length of each one, so a read is a single ranged GET. Objects
+    written by storage layers on top of this one are uploaded by the same workers.
+    """
+
     def __init__(self):
         s3_endpoint_url = os.getenv("S3_ENDPOINT_URL")
         s3_key_id = os.getenv("S3_KEY_ID")
@@ -95,8 +391,9 @@ class S3Storage(Storage):
             logger.warn("Please provide S3_ENDPOINT_URL, S3_KEY_ID and S3_ACCESS_KEY to use S3")
             raise NotImplementedError("S3_ENDPOINT_URL, S3_KEY_ID and S3_ACCESS_KEY to use S3")
 
+        # Clients are thread safe, unlike resources, so one is shared by the caller and the upload workers
         # noinspection PyUnresolvedReferences
-        s3 = boto3.resource(
+        self.client = boto3.client(
             "s3",
             endpoint_url=s3_endpoint_url,
             aws_access_key_id=s3_key_id,
@@ -105,22 +402,709 @@ class S3Storage(Storage):
             config=boto3.session.Config(signature_version="s3v4"),
             verify=False,
         )
-        self.bucket = s3.Bucket("job-search")
+        self.bucket_name = "job-search"
+
+        # Snapshot of the listing ids in the bucket, refreshed once it is older than S3_MANIFEST_TTL seconds
+        self.manifest_ttl = int(os.getenv("S3_MANIFEST_TTL", 600))
+        self.manifest: Set[str] | None = None
+        self.manifest_time = 0.0
+        self.manifest_lock = Lock()
+
+        # Location of packed descriptions as (pack key, offset, length), and the pack indexes already loaded
+        self.pack_index: Dict[str, Tuple[str, int, int]] = {}
+        self.loaded_packs: Set[str] = set()
+        self.packs_listed = False
+        self.pack_lock = Lock()
+
+        # Descriptions and objects which are queued but not uploaded yet
+        self.pending: Dict[str, str] = {}
+        self.pending_objects: Dict[str, bytes] = {}
+        self.pending_lock = Lock()
+        self.pack_size = int(os.getenv("S3_PACK_SIZE", 0))
+        self.upload_queue: Queue[Tuple[str, str] | ObjectUpload] = Queue(
+            maxsize=int(os.getenv("S3_UPLOAD_QUEUE_SIZE", 256))
+        )
+        self.upload_workers = int(os.getenv("S3_UPLOAD_WORKERS", 4))
+        for _ in range(self.upload_workers):
+            Thread(target=self._upload_worker, daemon=True).start()
+        atexit.register(self.flush)
 
     def write_description(self, description: str, listing_id: str) -> None:
         if description == "":
             logger.debug(f"Description for {listing_id} was empty")
             return
-        self.bucket.put_object(Key=listing_id + ".txt", Body=description)
+        if self.upload_workers == 0:
+            self._put_description(listing_id, description)
+        else:
+            with self.pending_lock:
+                self.pending[listing_id] = description
+            # Blocks while the queue is full, so scraping can't get too far ahead of uploads
+            self.upload_queue.put((listing_id, description))
+        with self.manifest_lock:
+            if self.manifest is not None:
+                self.manifest.add(listing_id)
 
     def read_description(self, listing_id: str) -> str:
-        obj = self.bucket.Object(listing_id + ".txt").get()
+        with self.pending_lock:
+            if listing_id in self.pending:
+                return self.pending[listing_id]
+        if (packed := self._read_packed(listing_id)) is not None:
+            return packed
+        try:
+            obj = self.client.get_object(Bucket=self.bucket_name, Key=listing_id + ".txt")
+        except self.client.exceptions.NoSuchKey:
+            # It may have been packed by another process since the pack indexes were loaded
+            self._load_pack_indexes()
+            if (packed := self._read_packed(listing_id)) is not None:
+                return packed
+            raise
         return obj["Body"].read().decode("utf-8")
 
     def description_downloaded(self, listing_id: str) -> bool:
+        with self.pending_lock:
+            if listing_id in self.pending:
+                return True
+        self._ensure_pack_indexes()
+        with self.pack_lock:
+            if listing_id in self.pack_index:
+                return True
         # noinspection PyUnresolvedReferences
         try:
-            self.bucket.Object(listing_id + ".txt").load()
+            self.client.head_object(Bucket=self.bucket_name, Key=listing_id + ".txt")
             return True
         except botocore.exceptions.ClientError:
             return False
+
+    def descriptions_downloaded(self, listing_ids: Iterable[str]) -> Set[str]:
+        """
+        Answers from a snapshot of the bucket's keys, taken with paginated list_objects_v2 requests (1000 keys each).
+        Small batches are checked with HEAD requests instead, since listing the bucket costs more than a few HEADs.
+        """
+        listing_ids = set(listing_ids)
+        if len(listing_ids) < S3_HEAD_LIMIT:
+            # Packed descriptions have no object of their own, so only the rest need a HEAD
+            self._ensure_pack_indexes()
+            with self.pack_lock:
+                packed = listing_ids & self.pack_index.keys()
+            return packed | super().descriptions_downloaded(listing_ids - packed)
+        return listing_ids & self._get_manifest()
+
+    def flush(self) -> None:
+        """
+        Blocks until every queued description has been uploaded.
+        """
+        if self.upload_workers > 0:
+            self.upload_queue.join()
+
+    def write_object(self, key: str, data: bytes) -> None:
+        self.write_objects({key: data})
+
+    def write_objects(self, objects: Dict[str, bytes], if_missing: Iterable[str] = ()) -> None:
+        upload = ObjectUpload(objects, set(if_missing))
+        if self.upload_workers == 0:
+            self._put_objects(upload)
+            return
+        with self.pending_lock:
+            self.pending_objects.update(objects)
+        # Queued as one item so one worker uploads the objects in order
+        self.upload_queue.put(upload)
+
+    def read_object(self, key: str) -> bytes | None:
+        with self.pending_lock:
+            if key in self.pending_objects:
+                return self.pending_objects[key]
+        try:
+            return self.client.get_object(Bucket=self.bucket_name, Key=S3_OBJECT_PREFIX + key)["Body"].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def objects_exist(self, keys: Iterable[str]) -> Set[str]:
+        keys = set(keys)
+        with self.pending_lock:
+            existing = keys & self.pending_objects.keys()
+        keys -= existing
+        if len(keys) < S3_HEAD_LIMIT:
+            return existing | {key for key in keys if self._object_exists(key)}
+
+        # List only the prefixes shared by the keys, e.g. "objects/refs/ab/"
+        paginator = self.client.get_paginator("list_objects_v2")
+        for prefix in {key.rpartition("/")[0] for key in keys}:
+            list_prefix = S3_OBJECT_PREFIX + (prefix + "/" if prefix != "" else "")
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=list_prefix):
+                for obj in page.get("Contents", []):
+                    if (key := obj["Key"].removeprefix(S3_OBJECT_PREFIX)) in keys:
+                        existing.add(key)
+        return existing
+
+    def _get_manifest(self) -> Set[str]:
+        """
+        Returns the snapshot of listing ids in the bucket, refreshing it if it has expired.
+        """
+        with self.manifest_lock:
+            if self.manifest is not None and time.monotonic() - self.manifest_time < self.manifest_ttl:
+                return self.manifest
+
+            manifest = set()
+            pack_indexes = []
+            paginator = self.client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket_name):
+                for obj in page.get("Contents", []):
+                    if obj["Key"].endswith(".txt"):
+                        manifest.add(obj["Key"].removesuffix(".txt"))
+                    elif obj["Key"].startswith(S3_PACK_PREFIX) and obj["Key"].endswith(".json"):
+                        pack_indexes.append(obj["Key"])
+            self._load_pack_indexes(pack_indexes)
+            with self.pack_lock:
+                manifest |= self.pack_index.keys()
+            with self.pending_lock:
+                manifest |= self.pending.keys()
+            logger.debug(f"Listed {len(manifest)} descriptions in S3")
+
+            self.manifest = manifest
+            self.manifest_time = time.monotonic()
+            return manifest
+
+    def _object_exists(self, key: str) -> bool:
+        # noinspection PyUnresolvedReferences
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=S3_OBJECT_PREFIX + key)
+            return True
+        except botocore.exceptions.ClientError:
+            return False
+
+    def _put_objects(self, upload: ObjectUpload) -> None:
+        for key, data in upload.objects.items():
+            if key in upload.if_missing and self._object_exists(key):
+                continue
+            self.client.put_object(Bucket=self.bucket_name, Key=S3_OBJECT_PREFIX + key, Body=data)
+
+    def _put_description(self, listing_id: str, description: str) -> None:
+        self.client.put_object(Bucket=self.bucket_name, Key=listing_id + ".txt", Body=description.encode("utf-8"))
+
+    def _put_pack(self, descriptions: List[Tuple[str, str]]) -> None:
+        """
+        Uploads the descriptions as one pack object followed by its index. The index is uploaded last so a pack is
+        never referenced before it exists.
+        """
+        pack_id = uuid.uuid4().hex
+        pack_key = f"{S3_PACK_PREFIX}{pack_id}.pack"
+        body = bytearray()
+        index = {}
+        for listing_id, description in descriptions:
+            data = gzip.compress(description.encode("utf-8"))
+            index[listing_id] = [len(body), len(data)]
+            body += data
+        self.client.put_object(Bucket=self.bucket_name, Key=pack_key, Body=bytes(body))
+        self.client.put_object(
+            Bucket=self.bucket_name, Key=f"{S3_PACK_PREFIX}{pack_id}.json", Body=json.dumps(index).encode("utf-8")
+        )
+        with self.pack_lock:
+            for listing_id, (offset, length) in index.items():
+                self.pack_index[listing_id] = (pack_key, offset, length)
+            self.loaded_packs.add(f"{S3_PACK_PREFIX}{pack_id}.json")
+
+    def _read_packed(self, listing_id: str) -> str | None:
+        with self.pack_lock:
+            location = self.pack_index.get(listing_id)
+        if location is None:
+            return None
+        pack_key, offset, length = location
+        byte_range = f"bytes={offset}-{offset + length - 1}"
+        obj = self.client.get_object(Bucket=self.bucket_name, Key=pack_key, Range=byte_range)
+        return gzip.decompress(obj["Body"].read()).decode("utf-8")
+
+    def _ensure_pack_indexes(self) -> None:
+        """
+        Loads the pack indexes the first time they're needed, later packs are found by the manifest or failed reads.
+        """
+        if not self.packs_listed:
+            self._load_pack_indexes()
+
+    def _load_pack_indexes(self, index_keys: List[str] | None = None) -> None:
+        """
+        Loads any pack indexes which haven't been loaded yet.
+
+        index_keys -- The keys of all pack indexes, listed from the bucket if not given
+        """
+        if index_keys is None:
+            index_keys = []
+            paginator = self.client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=S3_PACK_PREFIX):
+                index_keys += [obj["Key"] for obj in page.get("Contents", []) if obj["Key"].endswith(".json")]
+
+        with self.pack_lock:
+            new_keys = [key for key in index_keys if key not in self.loaded_packs]
+        for index_key in new_keys:
+            obj = self.client.get_object(Bucket=self.bucket_name, Key=index_key)
+            index = json.loads(obj["Body"].read())
+            pack_key = index_key.removesuffix(".json") + ".pack"
+            with self.pack_lock:
+                for listing_id, (offset, length) in index.items():
+                    self.pack_index[listing_id] = (pack_key, offset, length)
+                self.loaded_packs.add(index_key)
+        self.packs_listed = True
+
+    def _upload_worker(self) -> None:
+        """
+        Uploads queued descriptions, packing up to S3_PACK_SIZE of them together if packing is enabled, and queued
+        objects.
+        """
+        while True:
+            item = self.upload_queue.get()
+            if isinstance(item, ObjectUpload):
+                self._upload_objects(item)
+                continue
+            batch = [item]
+            while len(batch) < self.pack_size:
+                try:
+                    item = self.upload_queue.get(timeout=S3_PACK_WAIT)
+                except Empty:
+                    break
+                if isinstance(item, ObjectUpload):
+                    self._upload_objects(item)
+                else:
+                    batch.append(item)
+
+            try:
+                if len(batch) > 1:
+                    self._put_pack(batch)
+                else:
+                    self._put_description(*batch[0])
+            except Exception as e:
+                logger.warn(f"Error uploading {len(batch)} descriptions: {type(e).__name__} - {e}")
+                # They will be downloaded again as missing descriptions
+                with self.manifest_lock:
+                    if self.manifest is not None:
+                        self.manifest -= {listing_id for listing_id, _ in batch}
+            finally:
+                with self.pending_lock:
+                    for listing_id, description in batch:
+                        if self.pending.get(listing_id) is description:
+                            del self.pending[listing_id]
+                for _ in batch:
+                    self.upload_queue.task_done()
+
+    def _upload_objects(self, upload: ObjectUpload) -> None:
+        try:
+            self._put_objects(upload)
+        except Exception as e:
+            logger.warn(f"Error uploading {len(upload.objects)} objects: {type(e).__name__} - {e}")
+        finally:
+            with self.pending_lock:
+                for key, data in upload.objects.items():
+                    if self.pending_objects.get(key) is data:
+                        del self.pending_objects[key]
+            self.upload_queue.task_done()
+
+
+# Maximum number of parameters in a single SQLite query
+SQLITE_BATCH_SIZE = 500
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores descriptions in a single SQLite database file. The database is in WAL mode so reads aren't blocked by writes,
+    and is memory mapped so lookups by the indexed listing id are served from the page cache.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mmap_size = int(os.getenv("SQLITE_MMAP_MB", 1024)) * 1024 * 1024
+        # Connections can't be shared between threads, so each thread gets its own
+        self.local = local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS description (id TEXT PRIMARY KEY, body TEXT NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS object (key TEXT PRIMARY KEY, data BLOB NOT NULL)")
+
+    def write_description(self, description: str, listing_id: str) -> None:
+        self.write_descriptions({listing_id: description})
+
+    def write_descriptions(self, descriptions: Dict[str, str]) -> None:
+        """
+        Writes all the descriptions in a single transaction.
+        """
+        rows = [(listing_id, description) for listing_id, description in descriptions.items() if description != ""]
+        for listing_id in descriptions.keys() - {listing_id for listing_id, _ in rows}:
+            logger.debug(f"Description for {listing_id} was empty")
+        if len(rows) > 0:
+            with self._connection() as connection:
+                connection.executemany("INSERT OR REPLACE INTO description (id, body) VALUES (?, ?)", rows)
+
+    def read_description(self, listing_id: str) -> str | None:
+        return self.read_descriptions([listing_id]).get(listing_id)
+
+    def read_descriptions(self, listing_ids: Iterable[str]) -> Dict[str, str]:
+        return dict(self._select_batches("SELECT id, body FROM description WHERE id IN ({})", listing_ids))
+
+    def description_downloaded(self, listing_id: str) -> bool:
+        return listing_id in self.descriptions_downloaded([listing_id])
+
+    def descriptions_downloaded(self, listing_ids: Iterable[str]) -> Set[str]:
+        return {row[0] for row in self._select_batches("SELECT id FROM description WHERE id IN ({})", listing_ids)}
+
+    def write_object(self, key: str, data: bytes) -> None:
+        with self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO object (key, data) VALUES (?, ?)", (key, data))
+
+    def read_object(self, key: str) -> bytes | None:
+        rows = self._select_batches("SELECT key, data FROM object WHERE key IN ({})", [key])
+        return rows[0][1] if len(rows) > 0 else None
+
+    def objects_exist(self, keys: Iterable[str]) -> Set[str]:
+        return {row[0] for row in self._select_batches("SELECT key FROM object WHERE key IN ({})", keys)}
+
+    def _select_batches(self, query: str, values: Iterable[str]) -> List[tuple]:
+        """
+        Runs the query for batches of the values, which are substituted into the "{}" of the query's IN clause.
+        """
+        values = list(dict.fromkeys(values))
+        rows = []
+        connection = self._connection()
+        for i in range(0, len(values), SQLITE_BATCH_SIZE):
+            batch = values[i : i + SQLITE_BATCH_SIZE]
+            rows += connection.execute(query.format(", ".join("?" * len(batch))), batch).fetchall()
+        return rows
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Returns this thread's connection, opening it if needed. Used as a context manager, it commits on success.
+        """
+        if (connection := getattr(self.local, "connection", None)) is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={self.mmap_size}")
+            self.local.connection = connection
+        return connection
+
+
+class CachedStorage(Storage):
+    """
+    Read-through cache in front of another storage. Descriptions are cached in memory and in a local directory, each
+    bounded in bytes and evicted least recently used first. Writes go through to the wrapped storage and the cache.
+    """
+
+    def __init__(self, storage: Storage, cache_directory: str, memory_bytes: int, disk_bytes: int):
+        self.storage = storage
+        self.cache_directory = cache_directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.lock = Lock()
+
+        self.memory: OrderedDict[str, str] = OrderedDict()
+        self.memory_size = 0
+        # Sizes of the descriptions cached on disk, least recently used first
+        self.disk: OrderedDict[str, int] = OrderedDict()
+        self.disk_size = 0
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_directory, exist_ok=True)
+        cached = []
+        for shard in os.scandir(cache_directory):
+            if shard.is_dir():
+                for entry in os.scandir(shard.path):
+                    stat = entry.stat()
+                    cached.append((stat.st_atime, entry.name.removesuffix(".txt"), stat.st_size))
+        for _, listing_id, size in sorted(cached):
+            self.disk[listing_id] = size
+            self.disk_size += size
+        self._evict()
+
+    def write_description(self, description: str, listing_id: str) -> None:
+        self.storage.write_description(description, listing_id)
+        if description != "":
+            self._cache(listing_id, description)
+
+    def read_description(self, listing_id: str) -> str | None:
+        with self.lock:
+            if listing_id in self.memory:
+                self.memory.move_to_end(listing_id)
+                self.memory_hits += 1
+                return self.memory[listing_id]
+            on_disk = listing_id in self.disk
+            if on_disk:
+                self.disk.move_to_end(listing_id)
+
+        if on_disk:
+            try:
+                with open(self._cache_path(listing_id), "r") as f:
+                    description = f.read()
+                with self.lock:
+                    self.disk_hits += 1
+                self._cache_in_memory(listing_id, description)
+                return description
+            except FileNotFoundError:
+                # Evicted by another thread since the check
+                pass
+
+        with self.lock:
+            self.misses += 1
+        description = self.storage.read_description(listing_id)
+        if description is not None and description != "":
+            self._cache(listing_id, description)
+        return description
+
+    def description_downloaded(self, listing_id: str) -> bool:
+        with self.lock:
+            if listing_id in self.memory or listing_id in self.disk:
+                return True
+        return self.storage.description_downloaded(listing_id)
+
+    def descriptions_downloaded(self, listing_ids: Iterable[str]) -> Set[str]:
+        listing_ids = set(listing_ids)
+        with self.lock:
+            cached = {listing_id for listing_id in listing_ids if listing_id in self.memory or listing_id in self.disk}
+        return cached | self.storage.descriptions_downloaded(listing_ids - cached)
+
+    def archive_descriptions(self, listing_ids: Iterable[str]) -> int:
+        return self.storage.archive_descriptions(listing_ids)
+
+    def flush(self) -> None:
+        self.storage.flush()
+
+    @property
+    def hashes_without_reading(self) -> bool:
+        return self.storage.hashes_without_reading
+
+    def description_hash(self, listing_id: str) -> str | None:
+        return self.storage.description_hash(listing_id)
+
+    def stats(self) -> str:
+        """
+        Returns a summary of the cache's hit rate and size.
+        """
+        with self.lock:
+            total = self.memory_hits + self.disk_hits + self.misses
+            hit_rate = 0 if total == 0 else (self.memory_hits + self.disk_hits) / total
+            return (
+                f"{self.memory_hits} memory hits, {self.disk_hits} disk hits, {self.misses} misses ({hit_rate:.0%}), "
+                f"{self.memory_size} bytes in memory, {self.disk_size} bytes on disk"
+            )
+
+    def _cache(self, listing_id: str, description: str) -> None:
+        """
+        Adds the description to both cache tiers.
+        """
+        data = description.encode("utf-8")
+        path = self._cache_path(listing_id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+        except OSError as e:
+            logger.warn(f"Error caching description for listing {listing_id}: {type(e).__name__} - {e}")
+        else:
+            with self.lock:
+                self.disk_size += len(data) - self.disk.pop(listing_id, 0)
+                self.disk[listing_id] = len(data)
+        self._cache_in_memory(listing_id, description)
+
+    def _cache_in_memory(self, listing_id: str, description: str) -> None:
+        with self.lock:
+            if listing_id in self.memory:
+                self.memory_size -= len(self.memory.pop(listing_id).encode("utf-8"))
+            self.memory[listing_id] = description
+            self.memory_size += len(description.encode("utf-8"))
+        self._evict()
+
+    def _evict(self) -> None:
+        """
+        Removes the least recently used descriptions until both tiers are within their size limits.
+        """
+        evicted = []
+        with self.lock:
+            while self.memory_size > self.memory_bytes and len(self.memory) > 0:
+                self.memory_size -= len(self.memory.popitem(last=False)[1].encode("utf-8"))
+            while self.disk_size > self.disk_bytes and len(self.disk) > 0:
+                listing_id, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                evicted.append(listing_id)
+        for listing_id in evicted:
+            try:
+                os.remove(self._cache_path(listing_id))
+            except FileNotFoundError:
+                pass
+
+    def _cache_path(self, listing_id: str) -> str:
+        return f"{self.cache_directory}/{_shard(listing_id)}/{listing_id}.txt"
+
+
+class ContentAddressedStorage(Storage):
+    """
+    Stores descriptions once per distinct content, as compressed blobs keyed by their hash, with a small reference
+    object mapping each listing to the hash of its description. Both are written as objects of the wrapped storage.
+
+    Blobs are compressed with zstd when available (Python 3.14+), using a dictionary trained on the first
+    CAS_DICTIONARY_SAMPLES descriptions written since descriptions share most of their vocabulary, and zlib otherwise.
+    Descriptions previously written directly to the wrapped storage are still readable, and are moved into the content
+    addressed layout when first read.
+    """
+
+    # Blob header bytes for each compression method
+    ZLIB = b"z"
+    ZSTD = b"s"
+    ZSTD_DICT = b"d"
+
+    # Listings' references hold the hash of their description
+    hashes_without_reading = True
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+        self.lock = Lock()
+        self.refs: Dict[str, str] = {}
+        self.known_blobs: Set[str] = set()
+
+        self.dictionaries: Dict[int, "zstd.ZstdDict"] = {}
+        self.dictionary: "zstd.ZstdDict | None" = None
+        self.dictionary_samples: List[bytes] = []
+        self.dictionary_sample_count = int(os.getenv("CAS_DICTIONARY_SAMPLES", 1000))
+        if zstd is not None and (current := self.storage.read_object("dictionaries/current")) is not None:
+            self.dictionary = self._get_dictionary(int(current.decode("utf-8")))
+
+    def write_description(self, description: str, listing_id: str) -> None:
+        if description == "":
+            logger.debug(f"Description for {listing_id} was empty")
+            return
+        description_hash = hash_description(description)
+        blob_key = self._blob_key(description_hash)
+        with self.lock:
+            known = description_hash in self.known_blobs
+        objects = {}
+        if not known:
+            objects[blob_key] = self._compress(description.encode("utf-8"))
+        else:
+            logger.debug(f"Description for {listing_id} is a duplicate of {description_hash}")
+        # The blob is written first so a reference is never written without it, and is skipped if another listing's
+        # description already wrote it. Storage which uploads in the background does this check in the background too
+        objects[self._ref_key(listing_id)] = description_hash.encode("utf-8")
+        self.storage.write_objects(objects, if_missing=[blob_key])
+        with self.lock:
+            self.known_blobs.add(description_hash)
+            self.refs[listing_id] = description_hash
+
+    def read_description(self, listing_id: str) -> str | None:
+        if (description_hash := self._get_ref(listing_id)) is None:
+            return self._migrate(listing_id)
+        data = self.storage.read_object(self._blob_key(description_hash))
+        return None if data is None else self._decompress(data).decode("utf-8")
+
+    def description_downloaded(self, listing_id: str) -> bool:
+        return self._get_ref(listing_id) is not None or self.storage.description_downloaded(listing_id)
+
+    def descriptions_downloaded(self, listing_ids: Iterable[str]) -> Set[str]:
+        keys = {self._ref_key(listing_id): listing_id for listing_id in listing_ids}
+        downloaded = {keys[key] for key in self.storage.objects_exist(keys)}
+        legacy = set(keys.values()) - downloaded
+        if len(legacy) > 0:
+            downloaded |= self.storage.descriptions_downloaded(legacy)
+        return downloaded
+
+    def description_hash(self, listing_id: str) -> str | None:
+        if (description_hash := self._get_ref(listing_id)) is not None:
+            return description_hash
+        description = self._migrate(listing_id)
+        return None if description is None else hash_description(description)
+
+    def archive_descriptions(self, listing_ids: Iterable[str]) -> int:
+        return self.storage.archive_descriptions(listing_ids)
+
+    def flush(self) -> None:
+        self.storage.flush()
+
+    def _get_ref(self, listing_id: str) -> str | None:
+        with self.lock:
+            if listing_id in self.refs:
+                return self.refs[listing_id]
+        if (data := self.storage.read_object(self._ref_key(listing_id))) is None:
+            return None
+        description_hash = data.decode("utf-8")
+        with self.lock:
+            self.refs[listing_id] = description_hash
+        return description_hash
+
+    def _migrate(self, listing_id: str) -> str | None:
+        """
+        Reads a description written directly to the wrapped storage and rewrites it in the content addressed layout.
+        """
+        if not self.storage.description_downloaded(listing_id):
+            return None
+        description = self.storage.read_description(listing_id)
+        if description is not None and description != "":
+            self.write_description(description, listing_id)
+        return description
+
+    def _compress(self, data: bytes) -> bytes:
+        if zstd is None:
+            return self.ZLIB + zlib.compress(data, 9)
+
+        with self.lock:
+            dictionary = self.dictionary
+            train = dictionary is None and len(self.dictionary_samples) < self.dictionary_sample_count
+            if train:
+                self.dictionary_samples.append(data)
+                train = len(self.dictionary_samples) == self.dictionary_sample_count
+        if train:
+            dictionary = self._train_dictionary()
+
+        if dictionary is None:
+            return self.ZSTD + zstd.compress(data, level=10)
+        header = self.ZSTD_DICT + dictionary.dict_id.to_bytes(4, "big")
+        return header + zstd.compress(data, level=10, zstd_dict=dictionary)
+
+    def _decompress(self, data: bytes) -> bytes:
+        method, body = data[:1], data[1:]
+        if method == self.ZLIB:
+            return zlib.decompress(body)
+        if zstd is None:
+            raise NotImplementedError("Reading zstd compressed descriptions requires Python 3.14 or later")
+        if method == self.ZSTD:
+            return zstd.decompress(body)
+        dictionary = self._get_dictionary(int.from_bytes(body[:4], "big"))
+        return zstd.decompress(body[4:], zstd_dict=dictionary)
+
+    def _train_dictionary(self) -> "zstd.ZstdDict | None":
+        """
+        Trains a dictionary on the collected samples, stores it and makes it the dictionary for new blobs.
+        """
+        try:
+            dictionary = zstd.train_dict(self.dictionary_samples, 112 * 1024)
+        except zstd.ZstdError as e:
+            logger.warn(f"Unable to train description dictionary: {type(e).__name__} - {e}")
+            return None
+        self.storage.write_objects(
+            {
+                f"dictionaries/{dictionary.dict_id}": dictionary.dict_content,
+                "dictionaries/current": str(dictionary.dict_id).encode("utf-8"),
+            }
+        )
+        with self.lock:
+            self.dictionaries[dictionary.dict_id] = dictionary
+            self.dictionary = dictionary
+            self.dictionary_samples = []
+        logger.info(f"Trained description dictionary {dictionary.dict_id}")
+        return dictionary
+
+    def _get_dictionary(self, dict_id: int) -> "zstd.ZstdDict":
+        with self.lock:
+            if dict_id in self.dictionaries:
+                return self.dictionaries[dict_id]
+        content = self.storage.read_object(f"dictionaries/{dict_id}")
+        if content is None:
+            raise FileNotFoundError(f"Description dictionary {dict_id} is missing")
+        dictionary = zstd.ZstdDict(content)
+        with self.lock:
+            self.dictionaries[dict_id] = dictionary
+        return dictionary
+
+    @staticmethod
+    def _blob_key(description_hash: str) -> str:
+        return f"blobs/{description_hash[:2]}/{description_hash}"
+
+    @staticmethod
+    def _ref_key(listing_id: str) -> str:
+        return f"refs/{_shard(listing_id)}/{listing_id}"
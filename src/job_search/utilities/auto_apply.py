@@ -27,7 +27,7 @@ from job_search.model import SearchQuery, Listing, JobStatus, Status, User, Job,
 from job_search.sites.linkedin import LinkedIn
 from job_search.sites.seek import Seek
 from job_search.utilities.driver_util import seek_login, driver_pool, linkedin_login
-from job_search.utilities.job_util import pass_blacklist
+from job_search.utilities.job_util import pass_blacklist, save_listings
 from job_search.utilities.logger import configure_logging, logger
 
 SEEK_CONTINUE_BUTTON = 'button[data-testid="continue-button"]'
@@ -252,7 +252,7 @@ def get_listings(user: User) -> set[Listing]:
             page = 0
             while last_length != len(listings):
                 last_length = len(listings)
-                listings.update(site.get_listings_from_page(q, page))
+                listings.update(save_listings(site.get_listings_from_page(q, page)))
                 page += 1
 
     # Remove existing listings
@@ -1,3 +1,5 @@
+import os
+from datetime import datetime, timedelta
 from typing import List
 
 from dotenv import load_dotenv
@@ -8,21 +10,30 @@ from selenium.webdriver.support.wait import WebDriverWait
 from tqdm import tqdm
 
 from job_search.base_site import BaseSite
-from job_search.model import Listing, Job, JobStatus, Status, User
+from job_search.model import Listing, Job, JobStatus, Status, User, Site
+from job_search.storage import CachedStorage
 from job_search.utilities.create_summary import create_summary
+from job_search.utilities.description_fetcher import DescriptionFetcher
 from job_search.utilities.driver_util import linkedin_login, driver_pool
-from job_search.utilities.job_util import storage, pass_blacklist
+from job_search.utilities.job_util import storage, apply_blacklist
 from job_search.utilities.logger import logger, progress_bars, configure_logging
+from job_search.utilities.minhash import index_missing_descriptions, MINHASH_BACKFILL_LIMIT
 
 load_dotenv()
 
+# Descriptions of listings older than this are moved to the archive
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 30))
+ARCHIVE_BATCH_SIZE = 5000
+
 
 def clean():
     """
     - Update blacklisting
     - Check if listings have expired
     - Download missing descriptions
+    - Link listings with near-identical descriptions
     - Create summaries
+    - Archive old descriptions
     """
     configure_logging()
     logger.info("Starting clean")
@@ -30,21 +41,18 @@ def clean():
     reapply_blacklist()
     check_expired()
     missing_descriptions()
+    link_duplicate_descriptions()
     create_summary()
+    archive_descriptions()
+
+    if isinstance(storage, CachedStorage):
+        logger.info(f"Description cache: {storage.stats()}")
 
 
 def reapply_blacklist():
     logger.info("Reapplying blacklist")
-    for status in tqdm(JobStatus.select(), desc="Applying Blacklists", unit="job", disable=not progress_bars):
-        if pass_blacklist(status.job, status.user):
-            # It shouldn't be blacklisted but is
-            if status.status == Status.BLACKLIST:
-                status.status = Status.NEW
-        else:
-            # It should be blacklisted but isn't
-            if status.status == Status.NEW:
-                status.status = Status.BLACKLIST
-        status.save()
+    blacklisted, restored = apply_blacklist()
+    logger.info(f"Blacklisted {blacklisted} jobs, restored {restored} jobs")
 
 
 def check_expired():
@@ -103,22 +111,55 @@ def missing_descriptions():
     """
     logger.info("Downloading missing descriptions")
 
-    listings = Listing.select().join(Job).join(JobStatus).where(JobStatus.status << [Status.NEW, Status.INTERESTED])
-
-    clean_listings = []
-    for listing in tqdm(listings, desc="Looking for Descriptions", unit="listing", disable=not progress_bars):
-        if not storage.description_downloaded(listing.id):
-            clean_listings.append(listing)
-    listings = clean_listings
-
-    for listing in tqdm(listings, desc="Fetching Descriptions", unit="listing", disable=not progress_bars):
-        try:
-            description = BaseSite.get_site_instance(listing.site.name).get_listing_description(listing.id)
-            if description is not None:
-                storage.write_description(description, listing.id)
-                logger.info(f"Description saved for listing {listing.id}")
-        except Exception as e:
-            logger.warn(f"Error in fetching description for listing {listing.id}: {type(e).__name__} - {e}")
+    listings = list(
+        Listing.select(Listing, Site)
+        .join(Site)
+        .switch(Listing)
+        .join(Job)
+        .join(JobStatus)
+        .where(JobStatus.status << [Status.NEW, Status.INTERESTED])
+        .distinct()
+    )
+
+    downloaded = storage.descriptions_downloaded(listing.id for listing in listings)
+    listings = [listing for listing in listings if listing.id not in downloaded]
+
+    saved = DescriptionFetcher().fetch(listings)
+    logger.info(f"Saved {saved} of {len(listings)} missing descriptions")
+
+    # Wait for any background uploads so later stages and runs see every description
+    storage.flush()
+
+
+def link_duplicate_descriptions():
+    """
+    Indexes descriptions which were downloaded before near-duplicate detection, linking any near-identical listings to
+    one job. New descriptions are indexed as they're downloaded.
+    """
+    logger.info("Indexing descriptions for near-duplicates")
+    relinked = index_missing_descriptions(MINHASH_BACKFILL_LIMIT)
+    logger.info(f"Linked {relinked} listings to jobs with near-identical descriptions")
+
+
+def archive_descriptions():
+    """
+    Moves descriptions of expired and old listings into the archive in batches.
+    """
+    logger.info("Archiving old descriptions")
+
+    expired_jobs = JobStatus.select(JobStatus.job).where(JobStatus.status == Status.EXPIRED)
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    listing_ids = [
+        listing.id
+        for listing in Listing.select(Listing.id).where((Listing.timestamp < cutoff) | (Listing.job << expired_jobs))
+    ]
+
+    archived = 0
+    for i in tqdm(
+        range(0, len(listing_ids), ARCHIVE_BATCH_SIZE), desc="Archiving", unit="batch", disable=not progress_bars
+    ):
+        archived += storage.archive_descriptions(listing_ids[i : i + ARCHIVE_BATCH_SIZE])
+    logger.info(f"Archived {archived} descriptions")
 
 
 if __name__ == "__main__":
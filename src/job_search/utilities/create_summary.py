@@ -1,14 +1,18 @@
 import os
+from collections import defaultdict
+from typing import Dict, Iterable, List
 
-import psycopg2
 from dotenv import load_dotenv
 from ollama import Client
+from peewee import JOIN, fn
 from tqdm import tqdm
 
-from job_search.base_site import BaseSite
 from job_search.utilities.logger import logger, progress_bars, configure_logging
-from job_search.model import Listing
-from job_search.utilities.job_util import storage
+from job_search.model import Listing, Summary, JobStatus, Status, Job, db
+from job_search.storage import hash_description
+from job_search.utilities.job_util import storage, prioritised_chunks
+from job_search.utilities.preprocess import DescriptionPreprocessor
+from job_search.utilities.summariser import Summariser
 
 load_dotenv()
 
@@ -20,6 +24,8 @@ if model_name not in [m.model for m in client.list().models]:
     exit(1)
 
 SUMMARY_PROMPT = os.getenv("SUMMARY_PROMPT")
+# Identifies the prompt and preprocessing summaries were created with, so changing either re-summarises listings
+PROMPT_HASH = hash_description(f"{SUMMARY_PROMPT or ''}\n{DescriptionPreprocessor().config()}")
 
 
 def create_summary():
@@ -27,86 +33,175 @@ def create_summary():
 
     logger.info("Creating summaries")
 
-    connection = psycopg2.connect(
-        host=os.getenv("DATABASE_HOST"),
-        database=os.getenv("DATABASE_NAME", "job_search"),
-        user=os.getenv("DATABASE_USER"),
-        password=os.getenv("DATABASE_PASSWORD"),
+    mark_stale_summaries()
+
+    # Only listings whose statuses or description changed since they were last checked can need work
+    changed: List[Listing] = list(
+        Listing.select(Listing, Summary, Job)
+        .join(Summary, JOIN.LEFT_OUTER)
+        .switch(Listing)
+        .join(Job)
+        .where(Listing.summary_changed.is_null(False))
     )
-    cursor = connection.cursor()
-    # Get each listing with their summary and a pipe separated list of associated job statuses
-    cursor.execute("""
-        SELECT l.id, summary, STRING_AGG(js.status, '|')
-        FROM listing l
-                 JOIN job j ON j.id = l.job_id
-                 JOIN jobstatus js ON j.id = js.job_id
-        GROUP BY l.id
-        """)
+    statuses = defaultdict(list)
+    for job_id, status in (
+        JobStatus.select(JobStatus.job, JobStatus.status)
+        .where(JobStatus.job << list({listing.job_id for listing in changed}))
+        .tuples()
+    ):
+        statuses[job_id].append(status)
+    logger.info(f"Checking {len(changed)} changed listings")
+
     need_blacklist = []
     need_summary = []
-    for listing in tqdm(cursor.fetchall(), desc="Fetching", disable=not progress_bars):
-        statuses = listing[2].split("|")
+    for listing in changed:
+        job_statuses = statuses[listing.job_id]
+        if len(job_statuses) == 0:
+            continue
+        relevant = any(x in [Status.NEW, Status.INTERESTED] for x in job_statuses)
 
-        has_blacklist = [x == "BLACKLIST" for x in statuses]
+        has_blacklist = [x == Status.BLACKLIST for x in job_statuses]
         if all(has_blacklist):
-            if listing[1] != "blacklist":
+            if listing.summary != "blacklist":
                 # Listings with only blacklist status jobs and without the "blacklist" summary
-                need_blacklist.append(listing[0])
-        elif any(has_blacklist) and listing[1] == "blacklist":
+                need_blacklist.append(listing)
+        elif any(has_blacklist) and listing.summary == "blacklist":
             # Listings that have previously been given the "blacklist" summary, but now have an associated job that isn't blacklisted
-            need_summary.append(listing[0])
-        elif listing[1] in ["", "N/A", "blacklist", None] and any(x in ["NEW", "INTERESTED"] for x in statuses):
+            need_summary.append(listing)
+        elif listing.summary in ["", "N/A", "blacklist", None] and relevant:
             # Remaining jobs without summaries that are still relevant to users, or jobs that have been un-blacklisted
-            need_summary.append(listing[0])
-    connection.close()
-
-    need_blacklist = Listing.select().where(Listing.id << need_blacklist)
-    for l in need_blacklist:
-        l.summary = "blacklist"
-        l.save()
-
-    need_summary = Listing.select().where(Listing.id << need_summary)
-    # Remove any listings that we don't have a description for
-    need_summary = [listing for listing in need_summary if storage.description_downloaded(listing.id)]
-    for listing in tqdm(need_summary, disable=not progress_bars, desc="Summarising"):
-        # Download description if we haven't already
-        if not storage.description_downloaded(listing.id):
-            description = BaseSite.get_site_instance(listing.site.name).get_listing_description(listing.id)
-            if description is not None:
-                storage.write_description(description, listing.id)
-
-        summarise_and_save(listing)
-        logger.info(f"Summary saved for listing {listing.id}")
-
-
-def summarise_and_save(listing: Listing):
-    try:
-        description = storage.read_description(listing.id)
-        if description != "":
-            response = summary(str(description))
-        else:
-            response = "N/A"
-    except Exception as e:
-        logger.warn(f"Error in creating summary for {listing.id}: {type(e).__name__} - {e}")
-        response = "N/A"
-
-    listing.summary = response
-    listing.save()
-
-
-def summary(description):
-    response = client.chat(
-        model=model_name,
-        messages=[
+            need_summary.append(listing)
+        elif listing.summary_ref is not None and not is_current(listing.summary_ref) and relevant:
+            # Summaries created by a different model or prompt, which are only replaced while still relevant to users
+            need_summary.append(listing)
+
+    for listing in need_blacklist:
+        listing.summary = "blacklist"
+    Listing.bulk_update(need_blacklist, fields=[Listing.summary], batch_size=1000)
+
+    # Remove any listings that we don't have a description for, they're marked as changed once it's downloaded
+    downloaded = storage.descriptions_downloaded(listing.id for listing in need_summary)
+    need_summary = [listing for listing in need_summary if listing.id in downloaded]
+    need_summary_ids = {listing.id for listing in need_summary}
+    clear_changed([listing for listing in changed if listing.id not in need_summary_ids])
+
+    summariser = Summariser(os.getenv("OLLAMA_HOST"), model_name, SUMMARY_PROMPT)
+    # Boilerplate is learnt fresh each run from the most recent descriptions
+    preprocessor = DescriptionPreprocessor()
+    with tqdm(total=len(need_summary), disable=not progress_bars, desc="Summarising") as pbar:
+        for chunk in prioritised_chunks(need_summary):
+            summarise_and_save(summariser, preprocessor, chunk)
+            pbar.update(len(chunk))
+    logger.info(f"Summarising finished: {summariser.stats}")
+
+
+def summarise_and_save(summariser: Summariser, preprocessor: DescriptionPreprocessor, listings: List[Listing]):
+    """
+    Gives a batch of listings their summaries, reusing any existing summary of an identical description by the same
+    model and prompt, and preprocessing and summarising the remaining descriptions concurrently. Listings which couldn't
+    be summarised are given the "N/A" summary so they're retried next run.
+    """
+    descriptions = {}
+    hashes = {}
+    if storage.hashes_without_reading:
+        for listing in listings:
+            try:
+                if (description_hash := storage.description_hash(listing.id)) is not None:
+                    hashes[listing.id] = description_hash
+            except Exception as e:
+                logger.warn(f"Error in reading description for {listing.id}: {type(e).__name__} - {e}")
+    else:
+        # Hashing needs the descriptions anyway, so they're read once here and kept for summarising
+        try:
+            descriptions = storage.read_descriptions(listing.id for listing in listings)
+        except Exception as e:
+            logger.warn(f"Error in reading descriptions for {len(listings)} listings: {type(e).__name__} - {e}")
+        hashes = {listing_id: hash_description(description) for listing_id, description in descriptions.items()}
+
+    summaries = get_summaries(set(hashes.values()))
+    missing = {h: listing_id for listing_id, h in hashes.items() if h not in summaries}
+    logger.info(f"Summarising {len(missing)} new descriptions for {len(listings)} listings")
+    if len(missing) > 0:
+        if len(unread := [listing_id for listing_id in missing.values() if listing_id not in descriptions]) > 0:
+            descriptions.update(storage.read_descriptions(unread))
+        companies = {listing.id: listing.job.company for listing in listings}
+        preprocessor.learn(companies[listing_id] for listing_id in missing.values())
+        # Summaries are keyed by description hash so each distinct description is only sent once
+        created = summariser.summarise(
             {
-                "role": "system",
-                "content": SUMMARY_PROMPT,
-            },
-            {"role": "user", "content": description},
-        ],
-    )
-
-    return response.message.content
+                h: preprocessor.preprocess(descriptions[listing_id], companies[listing_id])
+                for h, listing_id in missing.items()
+                if descriptions.get(listing_id, "") != ""
+            }
+        )
+        if len(created) > 0:
+            Summary.insert_many(
+                [
+                    {"description_hash": h, "model": model_name, "prompt_hash": PROMPT_HASH, "text": text}
+                    for h, text in created.items()
+                ]
+            ).on_conflict_ignore().execute()
+            summaries.update(get_summaries(created.keys()))
+
+    for listing in listings:
+        summary_ref = summaries.get(hashes.get(listing.id))
+        listing.summary_ref = summary_ref
+        listing.summary = "N/A" if summary_ref is None else summary_ref.text
+    summarised = [listing for listing in listings if listing.summary_ref is not None]
+    if len(summarised) > 0:
+        Listing.bulk_update(summarised, fields=[Listing.summary, Listing.summary_ref])
+    # Written separately as Postgres types an all-NULL CASE from bulk_update as text, which summary_ref_id rejects
+    failed = [listing.id for listing in listings if listing.summary_ref is None]
+    if len(failed) > 0:
+        Listing.update(summary="N/A", summary_ref=None).where(Listing.id << failed).execute()
+    # Listings which couldn't be summarised stay changed so they're retried next run
+    clear_changed(summarised)
+
+
+def is_current(summary: Summary) -> bool:
+    """
+    Returns whether the summary was created with the current model and prompt.
+    """
+    return summary.model == model_name and summary.prompt_hash == PROMPT_HASH
+
+
+def mark_stale_summaries():
+    """
+    Marks every listing with a summary as changed the first time the summary model or prompt is changed, so their
+    summaries are checked against the new version.
+    """
+    if Summary.select().where(Summary.model == model_name, Summary.prompt_hash == PROMPT_HASH).exists():
+        return
+    stale = Listing.update(summary_changed=fn.NOW()).where(Listing.summary_ref.is_null(False)).execute()
+    logger.info(f"Summary model or prompt changed, marked {stale} listings to check")
+
+
+def clear_changed(listings: List[Listing]):
+    """
+    Marks the listings as checked, unless they've changed again since they were selected.
+    """
+    ids_by_changed = defaultdict(list)
+    for listing in listings:
+        ids_by_changed[listing.summary_changed].append(listing.id)
+    with db.atomic():
+        for changed, listing_ids in ids_by_changed.items():
+            Listing.update(summary_changed=None).where(
+                Listing.id << listing_ids, Listing.summary_changed == changed
+            ).execute()
+
+
+def get_summaries(description_hashes: Iterable[str]) -> Dict[str, Summary]:
+    """
+    Returns the existing summaries for the current model and prompt, keyed by description hash.
+    """
+    return {
+        summary.description_hash: summary
+        for summary in Summary.select().where(
+            Summary.description_hash << list(description_hashes),
+            Summary.model == model_name,
+            Summary.prompt_hash == PROMPT_HASH,
+        )
+    }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import BoundedSemaphore
+from time import sleep
+from typing import Dict, List
+
+from dotenv import load_dotenv
+from peewee import fn
+from tqdm import tqdm
+
+from job_search.base_site import BaseSite
+from job_search.model import Listing
+from job_search.utilities.job_util import storage, prioritised_chunks
+from job_search.utilities.logger import logger, progress_bars
+from job_search.utilities.minhash import index_descriptions
+
+load_dotenv()
+
+# Number of descriptions fetched at the same time across all sites
+DESCRIPTION_WORKERS = int(os.getenv("DESCRIPTION_WORKERS", 8))
+# Number of descriptions fetched at the same time from a single site
+DESCRIPTION_SITE_CONCURRENCY = int(os.getenv("DESCRIPTION_SITE_CONCURRENCY", 2))
+# Attempts made for each description before giving up until the next run
+DESCRIPTION_ATTEMPTS = int(os.getenv("DESCRIPTION_ATTEMPTS", 4))
+# Delay in seconds before the first retry, doubled for each retry after
+DESCRIPTION_RETRY_DELAY = float(os.getenv("DESCRIPTION_RETRY_DELAY", 2))
+
+
+class DescriptionFetcher:
+    """
+    Fetches listing descriptions on a pool of workers, limiting how many requests are made to each site at once.
+    Descriptions are written to storage as soon as they're fetched, so an interrupted run keeps its progress.
+    """
+
+    def __init__(
+        self,
+        workers: int = DESCRIPTION_WORKERS,
+        site_concurrency: int = DESCRIPTION_SITE_CONCURRENCY,
+        attempts: int = DESCRIPTION_ATTEMPTS,
+        retry_delay: float = DESCRIPTION_RETRY_DELAY,
+    ):
+        self.workers = workers
+        self.site_concurrency = site_concurrency
+        self.attempts = attempts
+        self.retry_delay = retry_delay
+        self.sites: Dict[str, BaseSite] = {}
+        self.site_slots: Dict[str, BoundedSemaphore] = {}
+
+    def fetch(self, listings: List[Listing]) -> int:
+        """
+        Fetches and saves the descriptions of the listings in priority order, returning how many were saved. Each chunk
+        is finished before the next is started, so the listings users will see next are fetched first.
+
+        listings -- The listings to fetch, with their site already selected so workers don't query the database.
+        """
+        # Set up the sites up front so workers only ever read these
+        for site_name in {listing.site.name for listing in listings}:
+            if site_name not in self.sites:
+                self.sites[site_name] = BaseSite.get_site_instance(site_name)
+                self.site_slots[site_name] = BoundedSemaphore(self.site_concurrency)
+
+        saved = 0
+        with (
+            tqdm(total=len(listings), desc="Fetching Descriptions", unit="listing", disable=not progress_bars) as pbar,
+            ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor,
+        ):
+            for chunk in prioritised_chunks(listings):
+                futures = {executor.submit(self.fetch_listing, listing): listing for listing in chunk}
+                saved_descriptions = {}
+                for future in as_completed(futures):
+                    listing = futures[future]
+                    try:
+                        if (description := future.result()) is not None:
+                            saved_descriptions[listing.id] = description
+                    except Exception as e:
+                        logger.warn(f"Error in fetching description for listing {listing.id}: {type(e).__name__} - {e}")
+                    pbar.update()
+                saved += len(saved_descriptions)
+                # New descriptions can be summarised, see create_summary
+                Listing.update(summary_changed=fn.NOW()).where(Listing.id << list(saved_descriptions)).execute()
+                relinked = index_descriptions(saved_descriptions)
+                if relinked > 0:
+                    logger.info(f"Linked {relinked} listings to jobs with near-identical descriptions")
+        return saved
+
+    def fetch_listing(self, listing: Listing) -> str | None:
+        """
+        Fetches and saves the description of a single listing, retrying with exponential backoff when the page couldn't
+        be fetched or didn't contain a description. Returns the description, or None if it wasn't found.
+
+        listing -- The listing to fetch.
+        """
+        site_name = listing.site.name
+        for attempt in range(self.attempts):
+            if attempt > 0:
+                # Back off outside the site's slot so other listings can use it in the meantime
+                sleep(self.retry_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+            with self.site_slots[site_name]:
+                try:
+                    description = self.sites[site_name].get_listing_description(listing.id)
+                except Exception as e:
+                    if attempt == self.attempts - 1:
+                        raise
+                    logger.debug(f"Attempt {attempt + 1} for listing {listing.id} failed: {type(e).__name__} - {e}")
+                    continue
+
+            if description is not None:
+                storage.write_description(description, listing.id)
+                logger.info(f"Description saved for listing {listing.id}")
+                return description
+            logger.debug(f"Attempt {attempt + 1} for listing {listing.id} found no description")
+
+        logger.warn(f"No description found for listing {listing.id} after {self.attempts} attempts")
+        return None
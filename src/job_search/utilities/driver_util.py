@@ -1,12 +1,16 @@
 import atexit
 import email
 import imaplib
+import os
 import re
 import time
 from contextlib import contextmanager
 from email.header import decode_header
-from queue import Queue
+from queue import Queue, Empty
+from threading import Lock
+from typing import List
 
+import requests
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from selenium import webdriver
@@ -16,19 +20,61 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.webdriver import WebDriver
 from selenium.webdriver.common.by import By
 from selenium_stealth import stealth
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 from job_search.model import User
 from job_search.utilities.logger import logger
 
 load_dotenv()
 
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 15))
 
-def get_page_soup(link: str) -> BeautifulSoup:
+# Markers which indicate that a plain HTTP response is a bot check or block page rather than real content
+BLOCK_PAGE_MARKERS = ["Just a moment...", "Access Denied", "Please verify you are a human"]
+
+
+def new_http_session() -> requests.Session:
+    """
+    Creates a requests session with a pooled, keep-alive connection adapter and browser-like headers.
+    Compressed responses (gzip/deflate) are requested and transparently decoded by requests.
+    """
+    http = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=int(os.getenv("HTTP_POOL_SIZE", 16)),
+        max_retries=Retry(total=2, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
+    )
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    http.headers.update(
+        {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+            "Chrome/131.0.0.0 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+            "Accept-Language": "en-US,en;q=0.9",
+            "Accept-Encoding": "gzip, deflate",
+        }
+    )
+    return http
+
+
+http_session = new_http_session()
+
+
+def get_page_soup(link: str, plain_http: bool = False, block_markers: List[str] | None = None) -> BeautifulSoup:
     """
     Returns a BeautifulSoup object for the given URL
 
     link -- The URL to get the page from
+    plain_http -- Whether to try a plain HTTP request before falling back to the browser
+    block_markers -- Additional site specific text which indicates the plain response is a block page
     """
+    if plain_http:
+        if (soup := get_http_soup(link, block_markers)) is not None:
+            return soup
+        logger.debug(f"Plain HTTP fetch failed for {link}, falling back to browser")
+
     with driver_pool.provide() as slot:
         driver = slot.driver
         driver.get(link)
@@ -37,6 +83,30 @@ def get_page_soup(link: str) -> BeautifulSoup:
     return soup
 
 
+def get_http_soup(link: str, block_markers: List[str] | None = None) -> BeautifulSoup | None:
+    """
+    Returns a BeautifulSoup object for the given URL using the shared HTTP session, or None if the request failed or
+    the response looks like a block page.
+
+    link -- The URL to get the page from
+    block_markers -- Additional site specific text which indicates the response is a block page
+    """
+    try:
+        response = http_session.get(link, timeout=HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        logger.debug(f"HTTP request for {link} failed: {type(e).__name__} - {e}")
+        return None
+    if response.status_code != 200:
+        logger.debug(f"HTTP request for {link} returned status {response.status_code}")
+        return None
+
+    text = response.text
+    if any(marker in text for marker in BLOCK_PAGE_MARKERS + (block_markers or [])):
+        logger.debug(f"HTTP response for {link} looks like a block page")
+        return None
+    return BeautifulSoup(text, features="html.parser")
+
+
 def seek_login(user: User, slot: DriverSlot):
     driver = slot.driver
     driver.get("https://www.seek.com")
@@ -166,23 +236,53 @@ class DriverSlot:
 
 
 class DriverPool:
-    pool: Queue[DriverSlot] = Queue()
+    """
+    Pool of browser slots. Slots are only started when they are first needed, up to the configured size.
+    """
 
-    def __init__(self):
-        self.pool.put(DriverSlot())
+    pool: Queue[DriverSlot]
+
+    def __init__(self, size: int = 1):
+        self.size = max(size, 1)
+        self.pool = Queue()
+        self.created = 0
+        self.lock = Lock()
 
     @contextmanager
     def provide(self):
-        driver = self.pool.get()
+        driver = self._acquire()
         try:
             yield driver
         finally:
             self.pool.put(driver)
 
+    def _acquire(self) -> DriverSlot:
+        """
+        Takes an idle slot, starts a new one if the pool isn't full, or otherwise waits for a slot to be returned.
+        """
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            pass
+
+        with self.lock:
+            can_create = self.created < self.size
+            if can_create:
+                self.created += 1
+        if not can_create:
+            return self.pool.get()
+
+        try:
+            return DriverSlot()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
     def quit_all(self):
         while not self.pool.empty():
             self.pool.get().driver.quit()
 
 
-driver_pool = DriverPool()
+driver_pool = DriverPool(int(os.getenv("DRIVER_POOL_SIZE", 1)))
 atexit.register(lambda: driver_pool.quit_all())
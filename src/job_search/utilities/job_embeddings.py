@@ -0,0 +1,224 @@
+import atexit
+import os
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import List, Sequence, Tuple
+
+from dotenv import load_dotenv
+from ollama import Client
+
+from peewee import fn
+
+from job_search.model import Job, Listing
+from job_search.utilities.logger import logger
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+load_dotenv()
+
+# Jobs last seen longer ago than this are never matched, the same as exact matches in get_or_create_jobs
+MATCH_WINDOW_DAYS = 14
+# Number of titles embedded in a single request
+EMBED_BATCH_SIZE = 256
+
+
+def job_text(title: str, company: str) -> str:
+    return f"{title} at {company}"
+
+
+def company_key(company: str) -> str:
+    """
+    Returns the company's part of a job's fuzzy key, jobs are only ever matched to jobs with the same one.
+    """
+    return Job.make_fuzzy_key("", company)
+
+
+class JobEmbeddingIndex:
+    """
+    An in-memory index of embeddings of recent jobs' titles and companies, used to find jobs which are worded
+    differently but are the same (e.g. "Sr Backend Software Engineer" at "ACME" and "Senior Software Engineer - Backend"
+    at "Acme Pty Ltd"). Embeddings come from Ollama and are normalised so cosine similarity is a dot product. As with
+    near-duplicate descriptions, only jobs at the same company (compared by fuzzy key) are ever matched.
+
+    The index is saved to an npz file. When loaded, entries older than the match window are dropped and jobs created
+    since it was saved are embedded, so only new jobs are ever sent to Ollama.
+    """
+
+    def __init__(self, path: str, model_name: str, threshold: float, host: str | None = None):
+        self.path = path
+        self.model_name = model_name
+        self.threshold = threshold
+        self.client = Client(host=host)
+        self.lock = Lock()
+        self.loaded = False
+        self.dirty = False
+        self.job_ids = np.zeros(0, dtype=np.int64)
+        self.companies = np.zeros(0, dtype=np.str_)
+        self.last_seen = np.zeros(0, dtype=np.float64)
+        self.vectors = None
+
+    def match(self, jobs: Sequence[Tuple[str, str]]) -> Tuple[List[int | None], "np.ndarray"]:
+        """
+        Finds the most similar recent job for each (title, company) pair, or None if no job is similar enough.
+        Pairs which match an earlier pair in the same batch instead are given the negative, one-based position of that
+        pair, so the caller can create one job for both. Also returns the pairs' embeddings to add new jobs with.
+        This calls Ollama, so it shouldn't be called inside a transaction.
+
+        jobs -- The (title, company) pairs to match.
+        """
+        with self.lock:
+            self._ensure_loaded()
+        # Embedded outside the lock so other workers can match their own jobs meanwhile
+        queries = self._embed([job_text(title, company) for title, company in jobs])
+        companies = np.array([company_key(company) for _, company in jobs], dtype=np.str_)
+
+        with self.lock:
+            matches: List[int | None] = [None] * len(jobs)
+            if self.vectors is not None and len(self.job_ids) > 0:
+                cutoff = (datetime.now() - timedelta(days=MATCH_WINDOW_DAYS)).timestamp()
+                similarity = queries @ self.vectors.T
+                similarity[:, self.last_seen < cutoff] = -1
+                similarity[companies[:, None] != self.companies[None, :]] = -1
+                best = similarity.argmax(axis=1)
+                for i, j in enumerate(best):
+                    if similarity[i, j] >= self.threshold:
+                        matches[i] = int(self.job_ids[j])
+
+            # Pairs in the same batch can also be the same job
+            within = queries @ queries.T
+            for i in range(len(jobs)):
+                if matches[i] is not None:
+                    continue
+                for j in range(i):
+                    if matches[j] is None and companies[i] == companies[j] and within[i, j] >= self.threshold:
+                        matches[i] = -(j + 1)
+                        break
+            return matches, queries
+
+    def add(self, job_ids: List[int], companies: List[str], vectors: Sequence["np.ndarray"]) -> None:
+        """
+        Adds new jobs to the index.
+
+        job_ids -- The ids of the new jobs.
+        companies -- The jobs' companies.
+        vectors -- The jobs' embeddings, as returned by match.
+        """
+        with self.lock:
+            self._append(job_ids, companies, np.asarray(vectors), [datetime.now().timestamp()] * len(job_ids))
+            self.dirty = True
+
+    def touch(self, job_ids: Sequence[int]) -> None:
+        """
+        Marks jobs in the index as just seen, keeping them in the match window.
+        """
+        with self.lock:
+            self.last_seen[np.isin(self.job_ids, list(job_ids))] = datetime.now().timestamp()
+            self.dirty = True
+
+    def remove(self, job_ids: Sequence[int]) -> None:
+        """
+        Drops jobs from the index, e.g. if they no longer exist.
+        """
+        with self.lock:
+            keep = ~np.isin(self.job_ids, list(job_ids))
+            self._filter(keep)
+            self.dirty = True
+
+    def save(self) -> None:
+        """
+        Writes the index to disk if it has changed.
+        """
+        with self.lock:
+            if not self.dirty or self.vectors is None:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = self.path + ".tmp.npz"
+            np.savez(
+                tmp,
+                model=np.array(self.model_name),
+                job_ids=self.job_ids,
+                companies=self.companies,
+                last_seen=self.last_seen,
+                vectors=self.vectors,
+            )
+            os.replace(tmp, self.path)
+            self.dirty = False
+            logger.info(f"Saved {len(self.job_ids)} job embeddings")
+
+    def _ensure_loaded(self) -> None:
+        """
+        Loads the saved index, drops expired entries and embeds any jobs created since it was saved.
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+
+        if os.path.exists(self.path):
+            with np.load(self.path) as saved:
+                # Indexes saved before companies were kept are rebuilt, so every entry can be compared
+                if str(saved["model"]) == self.model_name and "companies" in saved.files:
+                    self.job_ids = saved["job_ids"]
+                    self.companies = saved["companies"]
+                    self.last_seen = saved["last_seen"]
+                    self.vectors = saved["vectors"]
+                else:
+                    logger.info("Job embedding model changed, rebuilding the index")
+        cutoff = datetime.now() - timedelta(days=MATCH_WINDOW_DAYS)
+        self._filter(self.last_seen >= cutoff.timestamp())
+
+        # Embed recent jobs which aren't in the index yet
+        newest = int(self.job_ids.max()) if len(self.job_ids) > 0 else 0
+        last_seen = Listing.select(fn.MAX(Listing.timestamp)).where(Listing.job == Job.id)
+        missing = list(
+            Job.select(Job.id, Job.title, Job.company, last_seen).where(Job.id > newest, last_seen >= cutoff).tuples()
+        )
+        for i in range(0, len(missing), EMBED_BATCH_SIZE):
+            batch = missing[i : i + EMBED_BATCH_SIZE]
+            vectors = self._embed([job_text(title, company) for _, title, company, _ in batch])
+            self._append(
+                [job_id for job_id, *_ in batch],
+                [company for _, _, company, _ in batch],
+                vectors,
+                [t.timestamp() for *_, t in batch],
+            )
+        if len(missing) > 0:
+            self.dirty = True
+            logger.info(f"Embedded {len(missing)} recent jobs")
+
+    def _embed(self, texts: List[str]) -> "np.ndarray":
+        response = self.client.embed(model=self.model_name, input=texts)
+        vectors = np.asarray(response.embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _append(self, job_ids: List[int], companies: List[str], vectors: "np.ndarray", last_seen: List[float]) -> None:
+        self.job_ids = np.concatenate([self.job_ids, np.asarray(job_ids, dtype=np.int64)])
+        self.companies = np.concatenate(
+            [self.companies, np.array([company_key(company) for company in companies], dtype=np.str_)]
+        )
+        self.last_seen = np.concatenate([self.last_seen, np.asarray(last_seen, dtype=np.float64)])
+        self.vectors = vectors if self.vectors is None else np.concatenate([self.vectors, vectors])
+
+    def _filter(self, keep: "np.ndarray") -> None:
+        self.job_ids = self.job_ids[keep]
+        self.companies = self.companies[keep]
+        self.last_seen = self.last_seen[keep]
+        if self.vectors is not None:
+            self.vectors = self.vectors[keep]
+
+
+job_index: JobEmbeddingIndex | None = None
+if (embedding_model := os.getenv("JOB_EMBEDDING_MODEL")) is not None:
+    if np is None:
+        logger.warn("JOB_EMBEDDING_MODEL is set but numpy isn't installed, install the embeddings extra to use it")
+    else:
+        job_index = JobEmbeddingIndex(
+            os.path.join(os.getenv("DATA_DIRECTORY", "./data"), "job-embeddings.npz"),
+            embedding_model,
+            float(os.getenv("JOB_EMBEDDING_THRESHOLD", 0.92)),
+            host=os.getenv("OLLAMA_HOST"),
+        )
+        atexit.register(job_index.save)
@@ -1,15 +1,32 @@
 import os
 import re
 from datetime import datetime
+from threading import Lock
+from time import monotonic
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Set, Tuple
 
 from dotenv import load_dotenv
+from peewee import fn
 
-from job_search.model import Job, BlacklistTerm, User, Listing, JobTimestamp
-from job_search.storage import S3Storage, FileStorage, Storage
+from job_search.model import Job, BlacklistTerm, User, Listing, JobStatus, Status, db
+from job_search.storage import (
+    S3Storage,
+    FileStorage,
+    Storage,
+    CachedStorage,
+    ContentAddressedStorage,
+    SQLiteStorage,
+)
+from job_search.utilities.job_embeddings import job_index
 from job_search.utilities.logger import logger
 
 load_dotenv()
 
+# Number of listings in each chunk of prioritised work
+PRIORITY_CHUNK_SIZE = int(os.getenv("PRIORITY_CHUNK_SIZE", 50))
+# Minimum seconds between looking up users' triage queues to reprioritise the remaining listings
+PRIORITY_REFRESH_SECONDS = float(os.getenv("PRIORITY_REFRESH_SECONDS", 60))
+
 storage: Storage
 if os.getenv("S3_ENDPOINT_URL") is not None:  # Default to S3 if available
     try:
@@ -18,19 +35,91 @@ if os.getenv("S3_ENDPOINT_URL") is not None:  # Default to S3 if available
     except NotImplementedError as e:
         storage = FileStorage()
         logger.info("Unable to find S3 details. Defaulting to local file storage")
+elif (sqlite_path := os.getenv("SQLITE_STORAGE_PATH")) is not None:
+    storage = SQLiteStorage(sqlite_path)
+    logger.info(f"Using SQLite for storage at: {sqlite_path}")
 else:
     storage = FileStorage()
 
+if os.getenv("STORAGE_DEDUPLICATE", "false").lower() == "true":
+    storage = ContentAddressedStorage(storage)
+    logger.info("Storing descriptions by content hash")
+
+if (cache_directory := os.getenv("STORAGE_CACHE_DIRECTORY")) is not None:
+    storage = CachedStorage(
+        storage,
+        cache_directory,
+        memory_bytes=int(os.getenv("STORAGE_CACHE_MEMORY_MB", 64)) * 1024 * 1024,
+        disk_bytes=int(os.getenv("STORAGE_CACHE_DISK_MB", 1024)) * 1024 * 1024,
+    )
+    logger.info(f"Caching descriptions in {cache_directory}")
+
+
+class ListingRecord(NamedTuple):
+    """
+    A listing as parsed from a search page, before it is saved.
+    """
+
+    id: str
+    site: str
+    title: str
+    company: str
+
 
-def get_or_create_listing(l_id: str, site_string: str, title: str, company: str) -> Listing:
+class SimilarJob(NamedTuple):
     """
-    Returns an existing listing or creates a new listing if it is new
+    A job without a recent exact match, as looked up in the embedding index by match_similar_jobs.
     """
-    if (listing := Listing.get_or_none(Listing.id == l_id)) is not None:
-        return listing
-    listing = Listing.create(id=l_id, site=site_string, job=get_or_create_job(title, company))
-    logger.info(f"Created new listing {listing.id} for job {listing.job.id}")
-    return listing
+
+    job_id: int | None  # The existing job it's the same as
+    same_as: str | None  # The fuzzy key of an earlier job in the same batch it's the same as
+    vector: Any  # Its embedding, added to the index if the job is created
+
+
+def save_listings(records: List[ListingRecord], users: Iterable[User] = ()) -> List[Listing]:
+    """
+    Saves a page of parsed listings in a single transaction, creating any new jobs and listings, and a status for each
+    user for every listing's job if they don't already have one.
+
+    records -- The parsed listings to save
+    users -- The users to create statuses for, with their own blacklist applied
+    """
+    records = list({r.id: r for r in records}.values())
+    if len(records) == 0:
+        return []
+    listing_ids = [r.id for r in records]
+
+    # Embedding new jobs is slow, so it's done before the transaction rather than holding it open
+    similar = None
+    if job_index is not None:
+        existing = {listing.id for listing in Listing.select(Listing.id).where(Listing.id << listing_ids)}
+        similar = match_similar_jobs([(r.title, r.company) for r in records if r.id not in existing])
+
+    with db.atomic():
+        existing = {listing.id for listing in Listing.select(Listing.id).where(Listing.id << listing_ids)}
+        new_records = [r for r in records if r.id not in existing]
+        if len(new_records) > 0:
+            jobs = get_or_create_jobs(((r.title, r.company) for r in new_records), similar)
+            Listing.insert_many(
+                [
+                    {"id": r.id, "site": r.site, "job": jobs[Job.make_fuzzy_key(r.title, r.company)].id}
+                    for r in new_records
+                ]
+            ).on_conflict_ignore().execute()
+            for r in new_records:
+                logger.info(f"Created new listing {r.id} for job {jobs[Job.make_fuzzy_key(r.title, r.company)].id}")
+
+        listings = list(Listing.select(Listing, Job).join(Job).where(Listing.id << listing_ids))
+
+        statuses = []
+        for user in users:
+            for job in {listing.job.id: listing.job for listing in listings}.values():
+                status = Status.NEW if pass_blacklist(job, user) else Status.BLACKLIST
+                statuses.append({"user": user.id, "job": job.id, "status": status})
+        if len(statuses) > 0:
+            JobStatus.insert_many(statuses).on_conflict_ignore().execute()
+
+    return listings
 
 
 def get_or_create_job(title: str, company: str) -> Job:
@@ -38,44 +127,317 @@ def get_or_create_job(title: str, company: str) -> Job:
     Returns an existing job or creates a new job if it is new.
     Note: A job will be considered "new" if the last occurrence of the job was more than 14 days ago
     """
+    similar = match_similar_jobs([(title, company)])
+    with db.atomic():
+        return get_or_create_jobs([(title, company)], similar)[Job.make_fuzzy_key(title, company)]
 
-    def _get_fuzzy_job(inner_title: str, inner_company: str) -> str:
-        """
-        Turns the title and company into a fuzzy string by removing any non-word characters and the "ptyltd" suffix
-        """
-        return (
-            re.sub(r"\W", "", inner_title.lower())
-            + "-"
-            + re.sub(r"\W", "", inner_company.lower()).removesuffix("ptyltd")
+
+def get_or_create_jobs(jobs: Iterable[Tuple[str, str]], similar: Dict[str, SimilarJob] | None = None) -> Dict[str, Job]:
+    """
+    Resolves a batch of jobs with a single indexed lookup, creating any that are new. Returns the jobs keyed by their
+    fuzzy key (see Job.make_fuzzy_key).
+    Note: A job will be considered "new" if the last occurrence of the job was more than 14 days ago
+    Note: Must be called inside a transaction, which holds a lock on each job's key until it ends
+
+    jobs -- The (title, company) pairs to resolve
+    similar -- The jobs' matches in the embedding index from match_similar_jobs, looked up here if not given
+    """
+    wanted = fuzzy_keys(jobs)
+    if len(wanted) == 0:
+        return {}
+
+    # Sites are crawled in parallel, so the same new job can be found by two transactions at once. Each key is locked
+    # until the transaction ends so only the first creates it, and the other finds it. Keys are locked in order so two
+    # pages can't wait on each other
+    db.execute_sql(
+        "SELECT pg_advisory_xact_lock(hashtext(k)) FROM (SELECT k FROM unnest(%s::text[]) AS k ORDER BY k) AS keys",
+        (list(wanted),),
+    )
+    resolved = find_recent_jobs(wanted)
+    unresolved = [fuzzy_key for fuzzy_key in wanted if fuzzy_key not in resolved]
+    # Jobs worded differently to an existing job may still be the same job, with the embedding index enabled
+    if similar is None:
+        similar = _match_embeddings({fuzzy_key: wanted[fuzzy_key] for fuzzy_key in unresolved})
+    similar_ids = [similar[k].job_id for k in unresolved if k in similar and similar[k].job_id is not None]
+    similar_jobs = {job.id: job for job in Job.select().where(Job.id << similar_ids)} if len(similar_ids) > 0 else {}
+
+    new_keys = []
+    for fuzzy_key in unresolved:
+        match = similar.get(fuzzy_key)
+        if match is not None and match.job_id in similar_jobs:
+            logger.debug(f"Matched {wanted[fuzzy_key]} to similar job {match.job_id}")
+            resolved[fuzzy_key] = similar_jobs[match.job_id]
+        elif match is None or match.same_as not in wanted:
+            new_keys.append(fuzzy_key)
+
+    if len(new_keys) > 0:
+        created = (
+            Job.insert_many([{"title": wanted[k][0], "company": wanted[k][1], "fuzzy_key": k} for k in new_keys])
+            .returning(Job)
+            .execute()
         )
+        for job in created:
+            logger.debug(f"Added new job {job.id}")
+            resolved[job.fuzzy_key] = job
+        embedded = [k for k in new_keys if k in similar]
+        if job_index is not None and len(embedded) > 0:
+            job_index.add(
+                [resolved[k].id for k in embedded],
+                [wanted[k][1] for k in embedded],
+                [similar[k].vector for k in embedded],
+            )
+
+    # Jobs which matched another new job in the batch share its job
+    for fuzzy_key in wanted:
+        if fuzzy_key not in resolved:
+            resolved[fuzzy_key] = resolved[similar[fuzzy_key].same_as]
+
+    if job_index is not None:
+        job_index.touch([job.id for job in resolved.values()])
+    return resolved
+
+
+def fuzzy_keys(jobs: Iterable[Tuple[str, str]]) -> Dict[str, Tuple[str, str]]:
+    """
+    Returns the first (title, company) pair of each distinct fuzzy key among the jobs, keyed by it.
+    """
+    wanted: Dict[str, Tuple[str, str]] = {}
+    for title, company in jobs:
+        wanted.setdefault(Job.make_fuzzy_key(title, company), (title, company))
+    return wanted
 
-    existing_jobs = {_get_fuzzy_job(j.title, j.company): j.id for j in Job.select()}
 
-    if (job_fuzzy := _get_fuzzy_job(title, company)) in existing_jobs:
-        db_job = Job.get_by_id(existing_jobs[job_fuzzy])
+def find_recent_jobs(fuzzy_keys: Iterable[str]) -> Dict[str, Job]:
+    """
+    Returns the most recently seen job with each of the fuzzy keys, leaving out keys with no job seen in the last 14
+    days.
+    """
+    now = datetime.now()
+    # Correlated so only the candidates' listings are read, using the listing (job_id) index
+    last_seen = Listing.select(fn.MAX(Listing.timestamp)).where(Listing.job == Job.id)
+    candidates = Job.select(Job, last_seen.alias("last_seen")).where(Job.fuzzy_key << list(fuzzy_keys)).objects()
+    found: Dict[str, Job] = {}
+    for job in candidates:
+        # Jobs without a timestamp have no listings yet, so they were only just created
+        last_seen = job.last_seen or now
         # Checks if the most recent associate timestamp is less than 14 days ago
-        if abs((JobTimestamp.get(job=db_job).timestamp - datetime.now()).days) <= 14:
-            return db_job
-    job = Job.create(title=title, company=company)
-    logger.debug(f"Added new job {job.id}")
+        if abs((last_seen - now).days) > 14:
+            continue
+        if job.fuzzy_key not in found or last_seen > (found[job.fuzzy_key].last_seen or now):
+            found[job.fuzzy_key] = job
+    return found
+
 
-    return job
+def match_similar_jobs(jobs: Iterable[Tuple[str, str]]) -> Dict[str, SimilarJob]:
+    """
+    Looks up the jobs without a recent exact match in the embedding index (see JobEmbeddingIndex.match), keyed by
+    fuzzy key. This calls Ollama, so it should be done before the transaction the jobs are created in, and passed to
+    get_or_create_jobs. Nothing matches if the index is disabled or unavailable, so jobs are only matched by their
+    fuzzy key.
+    """
+    if job_index is None:
+        return {}
+    wanted = fuzzy_keys(jobs)
+    if len(wanted) == 0:
+        return {}
+    resolved = find_recent_jobs(wanted)
+    return _match_embeddings({k: pair for k, pair in wanted.items() if k not in resolved})
 
 
-def pass_blacklist(job: Job, user: User, auto_applier=False) -> bool:
+def _match_embeddings(wanted: Dict[str, Tuple[str, str]]) -> Dict[str, SimilarJob]:
+    if job_index is None or len(wanted) == 0:
+        return {}
+    keys = list(wanted)
+    try:
+        matches, vectors = job_index.match([wanted[k] for k in keys])
+    except Exception as e:
+        logger.warn(f"Error in matching similar jobs: {type(e).__name__} - {e}")
+        return {}
+    return {
+        k: SimilarJob(
+            match if match is not None and match > 0 else None,
+            keys[-match - 1] if match is not None and match < 0 else None,
+            vectors[i],
+        )
+        for i, (k, match) in enumerate(zip(keys, matches))
+    }
+
+
+class BlacklistMatcher:
+    """
+    A user's blacklist terms compiled for fast matching.
+    Title terms are case-insensitive and fuzzy, so they are combined into a single regex. Company terms are
+    case-sensitive and exact, so they are kept in a set.
+    """
+
+    def __init__(self, terms: Iterable[BlacklistTerm]):
+        title_terms = set()
+        self.companies = set()
+        for term in terms:
+            if term.type == "title":
+                title_terms.add(term.term.lower())
+            elif term.type == "company":
+                self.companies.add(term.term)
+        self.title_pattern = (
+            re.compile("|".join(re.escape(t) for t in sorted(title_terms, key=len, reverse=True)))
+            if len(title_terms) > 0
+            else None
+        )
+
+    def passes(self, title: str, company: str) -> bool:
+        """
+        Returns whether the job passes the blacklist, i.e. it matches none of the terms.
+        """
+        if company in self.companies:
+            return False
+        return self.title_pattern is None or self.title_pattern.search(title.lower()) is None
+
+
+# Compiled matchers keyed by (user id, auto applier terms only), along with a version per user so a matcher built
+# from terms that changed mid-build is never cached
+_blacklist_matchers: Dict[Tuple[int, bool], BlacklistMatcher] = {}
+_blacklist_versions: Dict[int, int] = {}
+_blacklist_lock = Lock()
+
+
+def get_blacklist_matcher(user_id: int, auto_applier=False) -> BlacklistMatcher:
+    """
+    Returns the compiled blacklist for the user, building it if it isn't cached.
+
+    user_id -- The id of the user
+    auto_applier -- Whether to only include terms which apply to the auto applier
+    """
+    key = (user_id, auto_applier)
+    with _blacklist_lock:
+        if (matcher := _blacklist_matchers.get(key)) is not None:
+            return matcher
+        version = _blacklist_versions.get(user_id, 0)
+
+    terms = BlacklistTerm.select().where(BlacklistTerm.user == user_id)
+    if auto_applier:
+        terms = terms.where(BlacklistTerm.auto_applier == True)
+    matcher = BlacklistMatcher(list(terms))
+
+    with _blacklist_lock:
+        if _blacklist_versions.get(user_id, 0) == version:
+            _blacklist_matchers[key] = matcher
+    return matcher
+
+
+def invalidate_blacklist(user_id: int) -> None:
+    """
+    Drops the cached blacklist for the user. Must be called whenever their blacklist terms change.
+    """
+    with _blacklist_lock:
+        _blacklist_versions[user_id] = _blacklist_versions.get(user_id, 0) + 1
+        for key in [k for k in _blacklist_matchers if k[0] == user_id]:
+            del _blacklist_matchers[key]
+
+
+def apply_blacklist(user: User | int | None = None) -> Tuple[int, int]:
+    """
+    Re-evaluates the blacklist in the database in a single statement. NEW statuses which match one of the user's terms
+    become BLACKLIST, and BLACKLIST statuses which no longer match any become NEW. Only the rows which change are
+    written. Matching is the same as pass_blacklist. Returns the number of statuses (blacklisted, restored).
+
+    user -- The user, or id of the user, to apply the blacklist for. Applies to all users if not given
+    """
+    sql = """
+        UPDATE jobstatus js
+        SET status = CASE WHEN js.status = %(blacklist)s THEN %(new)s ELSE %(blacklist)s END
+        FROM job j
+        WHERE j.id = js.job_id
+          AND js.status IN (%(new)s, %(blacklist)s)
+          AND (%(user_id)s IS NULL OR js.user_id = %(user_id)s)
+          -- Only rows where the current status disagrees with the blacklist
+          AND (js.status = %(blacklist)s) <> EXISTS (
+              SELECT 1
+              FROM blacklistterm bt
+              WHERE bt.user_id = js.user_id
+                AND ((bt.type = 'title' AND STRPOS(LOWER(j.title), LOWER(bt.term)) > 0)
+                  OR (bt.type = 'company' AND bt.term = j.company))
+          )
+        RETURNING js.status
+        """
+    params = {
+        "new": Status.NEW.name,
+        "blacklist": Status.BLACKLIST.name,
+        "user_id": None if user is None else (user.id if isinstance(user, User) else int(user)),
+    }
+    with db.atomic():
+        changed = [row[0] for row in db.execute_sql(sql, params).fetchall()]
+    blacklisted = changed.count(Status.BLACKLIST.name)
+    return blacklisted, len(changed) - blacklisted
+
+
+def pass_blacklist(job: Job, user: User | int, auto_applier=False) -> bool:
     """
     Applies the blacklist terms for the user to the given job
 
     job -- The job to apply the blacklist to
+    user -- The user, or id of the user, whose blacklist to apply
+    auto_applier -- Whether to only apply terms which apply to the auto applier
     """
+    user_id = user.id if isinstance(user, User) else int(user)
+    return get_blacklist_matcher(user_id, auto_applier).passes(job.title, job.company)
 
-    blacklist = BlacklistTerm.select().join(User, on=(BlacklistTerm.user == User.id)).where(User.id == user.id)
-    if auto_applier:
-        blacklist = blacklist.where(BlacklistTerm.auto_applier == True)
-    for term in blacklist:
-        # Title terms are case-insensitive and fuzzy, company terms are case-sensitive and exact
-        if (term.type == "title" and term.term.lower() in job.title.lower()) or (
-            term.type == "company" and term.term == job.company
-        ):
-            return False
-    return True
+
+def prioritise_listings(listings: List[Listing]) -> List[Listing]:
+    """
+    Orders listings by how soon a user is likely to look at them. Listings of jobs nearest the front of any user's
+    triage queue come first, followed by jobs a user is interested in, and then everything else, newest first.
+
+    listings -- The listings to order.
+    """
+    triage_positions, interested = get_priorities()
+
+    def priority(listing: Listing) -> tuple:
+        if listing.job_id in triage_positions:
+            return 0, triage_positions[listing.job_id], 0
+        if listing.job_id in interested:
+            return 1, 0, -listing.timestamp.timestamp()
+        return 2, 0, -listing.timestamp.timestamp()
+
+    return sorted(listings, key=priority)
+
+
+def get_priorities() -> Tuple[Dict[int, int], Set[int]]:
+    """
+    Returns the best position of each job in any user's triage queue, and the jobs any user is interested in.
+    """
+    # Triage shows each user their NEW jobs in id order, so a job's position is its row number in that order
+    position = fn.ROW_NUMBER().over(partition_by=[JobStatus.user], order_by=[JobStatus.job])
+    queue = (
+        JobStatus.select(JobStatus.job.alias("job_id"), position.alias("position"))
+        .where(JobStatus.status == Status.NEW)
+        .alias("queue")
+    )
+    triage_positions = dict(
+        JobStatus.select(queue.c.job_id, fn.MIN(queue.c.position)).from_(queue).group_by(queue.c.job_id).tuples()
+    )
+    interested = {
+        row[0] for row in JobStatus.select(JobStatus.job).where(JobStatus.status == Status.INTERESTED).tuples()
+    }
+    return triage_positions, interested
+
+
+def prioritised_chunks(
+    listings: List[Listing], chunk_size: int = PRIORITY_CHUNK_SIZE, refresh_seconds: float = PRIORITY_REFRESH_SECONDS
+) -> Iterator[List[Listing]]:
+    """
+    Yields the listings in chunks of the highest priority first. Users' queues are looked up again once the given
+    number of seconds has passed, and the remaining listings reordered, so work follows users' queues as they triage
+    during a long run without querying them before every chunk.
+
+    listings -- The listings to process.
+    chunk_size -- The number of listings in each chunk.
+    refresh_seconds -- The minimum time between looking up users' queues.
+    """
+    remaining = prioritise_listings(listings)
+    refreshed = monotonic()
+    while len(remaining) > 0:
+        if monotonic() - refreshed >= refresh_seconds:
+            remaining = prioritise_listings(remaining)
+            refreshed = monotonic()
+        yield remaining[:chunk_size]
+        remaining = remaining[chunk_size:]
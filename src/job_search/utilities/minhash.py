@@ -0,0 +1,219 @@
+import hashlib
+import os
+import random
+import re
+from array import array
+from datetime import datetime, timedelta
+from typing import Dict, List, Set
+
+from dotenv import load_dotenv
+from peewee import JOIN, fn
+
+from job_search.model import (
+    DescriptionBand,
+    DescriptionSignature,
+    Job,
+    JobStatus,
+    Listing,
+    Status,
+    db,
+)
+from job_search.utilities.job_util import storage
+from job_search.utilities.logger import logger
+
+load_dotenv()
+
+# Estimated Jaccard similarity of description shingles at which two listings are considered the same job
+MINHASH_THRESHOLD = float(os.getenv("MINHASH_THRESHOLD", 0.9))
+# Number of descriptions written before signatures were computed which are indexed by each clean
+MINHASH_BACKFILL_LIMIT = int(os.getenv("MINHASH_BACKFILL_LIMIT", 1000))
+
+# Number of words in each shingle
+SHINGLE_SIZE = 5
+# 16 bands of 8 rows make listings with a similarity above ~0.7 likely to share a bucket
+BANDS = 16
+ROWS = 8
+PERMUTATIONS = BANDS * ROWS
+# Jobs last seen longer ago than this are never linked to, the same as get_or_create_jobs
+LINK_WINDOW_DAYS = 14
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# Fixed seed so signatures are comparable between runs
+_rng = random.Random(0x6A6F6273)
+_PARAMETERS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(PERMUTATIONS)]
+
+
+def shingles(description: str) -> Set[int]:
+    """
+    Returns the hashes of each run of SHINGLE_SIZE words in the description, ignoring case and punctuation.
+    """
+    words = re.findall(r"\w+", description.lower())
+    if len(words) < SHINGLE_SIZE:
+        words += [""] * (SHINGLE_SIZE - len(words))
+    return {
+        int.from_bytes(hashlib.blake2b(" ".join(words[i : i + SHINGLE_SIZE]).encode(), digest_size=4).digest())
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def signature(description: str) -> array:
+    """
+    Returns the MinHash signature of the description, the minimum of each permutation of its shingle hashes.
+    """
+    hashes = shingles(description)
+    return array("I", [min(((a * h + b) % _PRIME) & _MAX_HASH for h in hashes) for a, b in _PARAMETERS])
+
+
+def buckets(sig: array) -> List[int]:
+    """
+    Returns the LSH bucket of each band of the signature, as signed 64-bit integers for Postgres.
+    """
+    return [
+        int.from_bytes(
+            hashlib.blake2b(sig[band * ROWS : (band + 1) * ROWS].tobytes(), digest_size=8).digest(), signed=True
+        )
+        for band in range(BANDS)
+    ]
+
+
+def similarity(sig: array, other: array) -> float:
+    """
+    Estimates the Jaccard similarity of two descriptions' shingles from their signatures.
+    """
+    return sum(1 for x, y in zip(sig, other) if x == y) / PERMUTATIONS
+
+
+def index_descriptions(descriptions: Dict[str, str]) -> int:
+    """
+    Saves the signatures and LSH buckets of newly written descriptions, then links each listing to the job of a
+    near-identical listing where it's safe to do so. Returns the number of listings relinked.
+
+    descriptions -- The descriptions keyed by listing id.
+    """
+    signatures = {listing_id: signature(d) for listing_id, d in descriptions.items() if d.strip() != ""}
+    if len(signatures) == 0:
+        return 0
+
+    with db.atomic():
+        DescriptionSignature.insert_many(
+            [{"listing": listing_id, "signature": sig.tobytes()} for listing_id, sig in signatures.items()]
+        ).on_conflict(
+            conflict_target=[DescriptionSignature.listing], preserve=[DescriptionSignature.signature]
+        ).execute()
+        DescriptionBand.insert_many(
+            [
+                {"listing": listing_id, "band": band, "bucket": bucket}
+                for listing_id, sig in signatures.items()
+                for band, bucket in enumerate(buckets(sig))
+            ]
+        ).on_conflict(
+            conflict_target=[DescriptionBand.listing, DescriptionBand.band], preserve=[DescriptionBand.bucket]
+        ).execute()
+
+    relinked = 0
+    for listing_id, sig in signatures.items():
+        try:
+            if link_duplicate(listing_id, sig):
+                relinked += 1
+        except Exception as e:
+            logger.warn(f"Error in linking listing {listing_id} to a duplicate: {type(e).__name__} - {e}")
+    return relinked
+
+
+def find_duplicates(listing_id: str, sig: array) -> List[str]:
+    """
+    Returns the listings whose descriptions are near-identical to the given listing's, most similar first.
+    """
+    conditions = None
+    for band, bucket in enumerate(buckets(sig)):
+        condition = (DescriptionBand.band == band) & (DescriptionBand.bucket == bucket)
+        conditions = condition if conditions is None else conditions | condition
+    candidates = DescriptionBand.select(DescriptionBand.listing).where(
+        conditions, DescriptionBand.listing != listing_id
+    )
+
+    scored = []
+    for other_id, other_sig in (
+        DescriptionSignature.select(DescriptionSignature.listing, DescriptionSignature.signature)
+        .where(DescriptionSignature.listing << candidates)
+        .tuples()
+    ):
+        score = similarity(sig, array("I", bytes(other_sig)))
+        if score >= MINHASH_THRESHOLD:
+            scored.append((score, other_id))
+    return [other_id for _, other_id in sorted(scored, reverse=True)]
+
+
+def link_duplicate(listing_id: str, sig: array) -> bool:
+    """
+    Moves the listing to the job of its most similar near-identical listing. This is conservative: it only happens when
+    both jobs are at the same company, the other job was seen recently, and nobody has triaged the listing's current
+    job, which must have no other listings. The listing's old job is then removed. Returns whether it was moved.
+    """
+    duplicates = find_duplicates(listing_id, sig)
+    if len(duplicates) == 0:
+        return False
+
+    listing = Listing.select(Listing, Job).join(Job).where(Listing.id == listing_id).get()
+    old_job: Job = listing.job
+    if Listing.select().where(Listing.job == old_job, Listing.id != listing_id).exists():
+        return False
+    untriaged = [Status.NEW, Status.BLACKLIST]
+    if JobStatus.select().where(JobStatus.job == old_job, JobStatus.status.not_in(untriaged)).exists():
+        return False
+
+    cutoff = datetime.now() - timedelta(days=LINK_WINDOW_DAYS)
+    company = Job.make_fuzzy_key("", old_job.company)
+    # Correlated so only the candidates' listings are read, using the listing (job_id) index
+    Recent = Listing.alias()
+    last_seen = Recent.select(fn.MAX(Recent.timestamp)).where(Recent.job == Job.id)
+    candidates = list(
+        Listing.select(Listing, Job)
+        .join(Job)
+        .where(Listing.id << duplicates, Job.id != old_job.id, last_seen >= cutoff)
+    )
+    for duplicate in sorted(candidates, key=lambda candidate: duplicates.index(candidate.id)):
+        new_job: Job = duplicate.job
+        if Job.make_fuzzy_key("", new_job.company) != company:
+            continue
+
+        with db.atomic():
+            # Users who hadn't seen the job yet keep their untriaged status on the job it's merged into
+            statuses = [
+                {"user": status.user_id, "job": new_job.id, "status": status.status}
+                for status in JobStatus.select().where(JobStatus.job == old_job)
+            ]
+            if len(statuses) > 0:
+                JobStatus.insert_many(statuses).on_conflict_ignore().execute()
+            Listing.update(job=new_job).where(Listing.id == listing_id).execute()
+            JobStatus.delete().where(JobStatus.job == old_job).execute()
+            Job.delete().where(Job.id == old_job.id).execute()
+        logger.info(
+            f"Linked listing {listing_id} to job {new_job.id} ({new_job.title}), duplicate of listing {duplicate.id}"
+        )
+        return True
+    return False
+
+
+def index_missing_descriptions(limit: int) -> int:
+    """
+    Indexes descriptions written before signatures were computed, up to the given number of listings, newest first.
+    Listings without a description are given an empty signature so they aren't checked again, and are indexed properly
+    once their description is written. Returns the number of listings relinked.
+    """
+    missing = [
+        listing.id
+        for listing in Listing.select(Listing.id)
+        .join(DescriptionSignature, JOIN.LEFT_OUTER, on=(DescriptionSignature.listing == Listing.id))
+        .where(DescriptionSignature.listing.is_null())
+        .order_by(Listing.timestamp.desc())
+        .limit(limit)
+    ]
+    descriptions = storage.read_descriptions(missing)
+    empty = [listing_id for listing_id in missing if descriptions.get(listing_id, "").strip() == ""]
+    if len(empty) > 0:
+        DescriptionSignature.insert_many(
+            [{"listing": listing_id, "signature": b""} for listing_id in empty]
+        ).on_conflict_ignore().execute()
+    return index_descriptions(descriptions)
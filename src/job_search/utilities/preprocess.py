@@ -0,0 +1,161 @@
+import os
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set
+
+from dotenv import load_dotenv
+from peewee import fn
+
+from job_search.model import Job, Listing
+from job_search.utilities.job_util import storage
+from job_search.utilities.logger import logger
+
+load_dotenv()
+
+# Approximate number of tokens of each description sent to the model. 0 disables truncation
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", 1024))
+# Number of recent descriptions of each company used to find its boilerplate
+BOILERPLATE_COMPANY_SAMPLE = int(os.getenv("BOILERPLATE_COMPANY_SAMPLE", 20))
+# Number of recent descriptions of any company used to find boilerplate common between companies
+BOILERPLATE_GLOBAL_SAMPLE = int(os.getenv("BOILERPLATE_GLOBAL_SAMPLE", 500))
+# Paragraphs in the descriptions of this many different jobs at a company are the company's boilerplate
+BOILERPLATE_COMPANY_REPEATS = int(os.getenv("BOILERPLATE_COMPANY_REPEATS", 3))
+# Paragraphs in the descriptions of this many different companies are boilerplate everywhere
+BOILERPLATE_GLOBAL_REPEATS = int(os.getenv("BOILERPLATE_GLOBAL_REPEATS", 5))
+
+# Shorter paragraphs (e.g. headings) are never treated as boilerplate
+MIN_BOILERPLATE_LENGTH = 40
+# Descriptions are left whole if removing boilerplate would leave less than this fraction of them
+MIN_REMAINING_FRACTION = 0.25
+# Rough number of characters per token for English text
+CHARS_PER_TOKEN = 4
+
+
+def split_paragraphs(description: str) -> List[str]:
+    """
+    Splits a description into its non-empty lines with surrounding whitespace removed.
+    """
+    return [line.strip() for line in description.splitlines() if line.strip() != ""]
+
+
+def paragraph_key(paragraph: str) -> str:
+    return re.sub(r"\s+", " ", paragraph.lower())
+
+
+class DescriptionPreprocessor:
+    """
+    Shortens descriptions before they're summarised. Boilerplate (EEO statements, benefits, "about us") is found by
+    looking for paragraphs repeated between different jobs of the same company, or between different companies, and is
+    removed. What remains is truncated to a token budget.
+    """
+
+    def __init__(
+        self,
+        token_budget: int = SUMMARY_TOKEN_BUDGET,
+        company_sample: int = BOILERPLATE_COMPANY_SAMPLE,
+        global_sample: int = BOILERPLATE_GLOBAL_SAMPLE,
+        company_repeats: int = BOILERPLATE_COMPANY_REPEATS,
+        global_repeats: int = BOILERPLATE_GLOBAL_REPEATS,
+    ):
+        self.token_budget = token_budget
+        self.company_sample = company_sample
+        self.global_sample = global_sample
+        self.company_repeats = company_repeats
+        self.global_repeats = global_repeats
+        self.company_boilerplate: Dict[str, Set[str]] = {}
+        # None until learned, as there may be no common boilerplate at all
+        self.global_boilerplate: Set[str] | None = None
+
+    def config(self) -> str:
+        """
+        Returns the settings which change the preprocessed text, to version summaries with.
+        """
+        return (
+            f"budget={self.token_budget};company={self.company_sample}/{self.company_repeats};"
+            f"global={self.global_sample}/{self.global_repeats}"
+        )
+
+    def learn(self, companies: Iterable[str]) -> None:
+        """
+        Finds the boilerplate of the companies, and boilerplate common between companies, from recent descriptions.
+
+        companies -- The companies whose descriptions will be preprocessed.
+        """
+        companies = set(companies) - self.company_boilerplate.keys()
+        if len(companies) == 0:
+            return
+        # Only each company's most recent listings are read, numbered newest first within the company
+        position = fn.ROW_NUMBER().over(partition_by=[Job.company], order_by=[Listing.timestamp.desc()])
+        ranked = (
+            Listing.select(Listing.id.alias("listing_id"), Job.title, Job.company, position.alias("position"))
+            .join(Job)
+            .where(Job.company << list(companies))
+            .alias("ranked")
+        )
+        samples = defaultdict(list)
+        for listing_id, title, company in (
+            Listing.select(ranked.c.listing_id, ranked.c.title, ranked.c.company)
+            .from_(ranked)
+            .where(ranked.c.position <= self.company_sample)
+            .tuples()
+        ):
+            samples[company].append((listing_id, title))
+
+        if self.global_boilerplate is None:
+            self.global_boilerplate = set()
+            if self.global_sample > 0:
+                recent = list(
+                    Listing.select(Listing.id, Job.title, Job.company)
+                    .join(Job)
+                    .order_by(Listing.timestamp.desc())
+                    .limit(self.global_sample)
+                    .tuples()
+                )
+                self.global_boilerplate = self._find_repeats(
+                    [(listing_id, company) for listing_id, _, company in recent], self.global_repeats
+                )
+
+        for company in companies:
+            self.company_boilerplate[company] = self._find_repeats(samples[company], self.company_repeats)
+        logger.info(
+            f"Found {sum(len(b) for b in self.company_boilerplate.values())} company and "
+            f"{len(self.global_boilerplate)} common boilerplate paragraphs"
+        )
+
+    def preprocess(self, description: str, company: str | None = None) -> str:
+        """
+        Removes boilerplate from the description and truncates it to the token budget.
+
+        description -- The description to preprocess.
+        company -- The company the description is for.
+        """
+        paragraphs = split_paragraphs(description)
+        boilerplate = (self.global_boilerplate or set()) | self.company_boilerplate.get(company, set())
+        kept = [p for p in paragraphs if paragraph_key(p) not in boilerplate]
+        # Reposts of one job can share almost everything, so never strip most of a description
+        if sum(len(p) for p in kept) < MIN_REMAINING_FRACTION * sum(len(p) for p in paragraphs):
+            kept = paragraphs
+
+        text = "\n".join(kept)
+        budget = self.token_budget * CHARS_PER_TOKEN
+        if self.token_budget > 0 and len(text) > budget:
+            # Cut at the last line or word break within the budget
+            cut = max(text.rfind("\n", 0, budget), text.rfind(" ", 0, budget))
+            text = text[: cut if cut > budget // 2 else budget]
+        return text
+
+    @staticmethod
+    def _find_repeats(samples: List[tuple], repeats: int) -> Set[str]:
+        """
+        Returns the paragraphs found in the descriptions of at least the given number of distinct groups.
+
+        samples -- Pairs of listing id and the group (job title or company) the listing belongs to.
+        repeats -- The number of groups a paragraph must appear in.
+        """
+        descriptions = storage.read_descriptions(listing_id for listing_id, _ in samples)
+        groups = defaultdict(set)
+        for listing_id, group in samples:
+            for paragraph in split_paragraphs(descriptions.get(listing_id, "")):
+                if len(paragraph) >= MIN_BOILERPLATE_LENGTH:
+                    groups[paragraph_key(paragraph)].add(group.lower())
+        return {key for key, found_in in groups.items() if len(found_in) >= repeats}
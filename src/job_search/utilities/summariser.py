@@ -0,0 +1,168 @@
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+from time import sleep, perf_counter
+from typing import Dict, List, Tuple
+
+from dotenv import load_dotenv
+from ollama import Client
+
+from job_search.utilities.logger import logger
+
+load_dotenv()
+
+# Number of requests sent to Ollama at the same time, should match OLLAMA_NUM_PARALLEL on the host
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", 2))
+# Seconds to wait for a single request before retrying it
+SUMMARY_TIMEOUT = float(os.getenv("SUMMARY_TIMEOUT", 300))
+# Attempts made for each request before giving up until the next run
+SUMMARY_ATTEMPTS = int(os.getenv("SUMMARY_ATTEMPTS", 3))
+# Descriptions shorter than this many characters are summarised several to a request. 0 disables batching
+SUMMARY_BATCH_CHARS = int(os.getenv("SUMMARY_BATCH_CHARS", 0))
+# Maximum number of descriptions in a batched request
+SUMMARY_BATCH_SIZE = int(os.getenv("SUMMARY_BATCH_SIZE", 4))
+
+BATCH_INSTRUCTIONS = (
+    "You will be given several numbered job descriptions. Follow the instructions above for each one separately and "
+    'respond only with JSON of the form {"summaries": ["summary of 1", "summary of 2", ...]}, with exactly one summary '
+    "per description, in order."
+)
+
+
+class SummaryStats:
+    """
+    Throughput of a summarisation run.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = perf_counter()
+        self.requests = 0
+        self.listings = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+
+    def record_request(self, prompt_tokens: int, output_tokens: int) -> None:
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.output_tokens += output_tokens
+
+    def record_summaries(self, listings: int) -> None:
+        with self.lock:
+            self.listings += listings
+
+    def __str__(self):
+        elapsed = max(perf_counter() - self.started, 1e-9)
+        return (
+            f"{self.listings} summaries from {self.requests} requests in {elapsed:.0f}s - "
+            f"{self.listings / elapsed:.2f} listings/s, {self.output_tokens / elapsed:.1f} output tokens/s, "
+            f"{self.prompt_tokens / elapsed:.1f} prompt tokens/s"
+        )
+
+
+class Summariser:
+    """
+    Summarises descriptions with Ollama, keeping several requests in flight and optionally packing short descriptions
+    into a single request. Failed requests are retried with backoff, and batches which can't be parsed are retried one
+    description at a time.
+    """
+
+    def __init__(
+        self,
+        host: str | None,
+        model_name: str,
+        prompt: str,
+        concurrency: int = SUMMARY_CONCURRENCY,
+        timeout: float = SUMMARY_TIMEOUT,
+        attempts: int = SUMMARY_ATTEMPTS,
+        batch_chars: int = SUMMARY_BATCH_CHARS,
+        batch_size: int = SUMMARY_BATCH_SIZE,
+    ):
+        self.client = Client(host=host, timeout=timeout)
+        self.model_name = model_name
+        self.prompt = prompt
+        self.concurrency = max(1, concurrency)
+        self.attempts = attempts
+        self.batch_chars = batch_chars
+        self.batch_size = batch_size
+        self.stats = SummaryStats()
+
+    def summarise(self, descriptions: Dict[str, str]) -> Dict[str, str]:
+        """
+        Summarises the descriptions, returning the summaries keyed the same way. Descriptions which couldn't be
+        summarised are left out.
+
+        descriptions -- The descriptions to summarise, keyed by any identifier.
+        """
+        summaries = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._summarise_batch, batch) for batch in self._batches(descriptions)]
+            for future in as_completed(futures):
+                summaries.update(future.result())
+        return summaries
+
+    def _batches(self, descriptions: Dict[str, str]) -> List[List[Tuple[str, str]]]:
+        """
+        Groups short descriptions into batches, leaving longer descriptions on their own.
+        """
+        batches = []
+        short = []
+        for key, description in descriptions.items():
+            if len(description) < self.batch_chars and self.batch_size > 1:
+                short.append((key, description))
+            else:
+                batches.append([(key, description)])
+        batches += [short[i : i + self.batch_size] for i in range(0, len(short), self.batch_size)]
+        return batches
+
+    def _summarise_batch(self, batch: List[Tuple[str, str]]) -> Dict[str, str]:
+        if len(batch) == 1:
+            key, description = batch[0]
+            summary = self._chat(self.prompt, description)
+            if summary is None:
+                return {}
+            self.stats.record_summaries(1)
+            return {key: summary}
+
+        content = "\n\n".join(f"Description {i}:\n{description}" for i, (_, description) in enumerate(batch, start=1))
+        response = self._chat(f"{self.prompt}\n\n{BATCH_INSTRUCTIONS}", content, json_format=True)
+        if response is None:
+            # Every attempt failed, so Ollama is likely unavailable and individual requests would fail too
+            return {}
+        try:
+            summaries = json.loads(response)["summaries"]
+            if len(summaries) == len(batch) and all(isinstance(s, str) for s in summaries):
+                self.stats.record_summaries(len(batch))
+                return {key: summary for (key, _), summary in zip(batch, summaries)}
+        except (TypeError, ValueError, KeyError):
+            pass
+        logger.debug(f"Unusable response for a batch of {len(batch)} descriptions, summarising individually")
+        summaries = {}
+        for item in batch:
+            summaries.update(self._summarise_batch([item]))
+        return summaries
+
+    def _chat(self, system: str, content: str, json_format: bool = False) -> str | None:
+        """
+        Sends a single request, retrying with exponential backoff. Returns None if every attempt failed.
+        """
+        for attempt in range(self.attempts):
+            if attempt > 0:
+                sleep(2**attempt * random.uniform(0.5, 1.5))
+            try:
+                response = self.client.chat(
+                    model=self.model_name,
+                    messages=[
+                        {"role": "system", "content": system},
+                        {"role": "user", "content": content},
+                    ],
+                    format="json" if json_format else None,
+                )
+                self.stats.record_request(response.prompt_eval_count or 0, response.eval_count or 0)
+                return response.message.content
+            except Exception as e:
+                logger.warn(f"Summary request failed (attempt {attempt + 1}): {type(e).__name__} - {e}")
+        return None